@@ -59,12 +59,11 @@ class MetricBuffer:
     current_interval = now - (now % self.aggregation_frequency)
     age_threshold = current_interval - (settings['MAX_AGGREGATION_INTERVALS'] * self.aggregation_frequency)
 
+    datapoints = []
     for buffer in self.interval_buffers.values():
       if buffer.active:
         value = self.aggregation_func(buffer.values)
-        datapoint = (buffer.interval, value)
-        state.events.metricGenerated(self.metric_path, datapoint)
-        state.instrumentation.increment('aggregateDatapointsSent')
+        datapoints.append((self.metric_path, (buffer.interval, value)))
         buffer.mark_inactive()
 
       if buffer.interval < age_threshold:
@@ -74,6 +73,10 @@ class MetricBuffer:
           self.configured = False
           del BufferManager.buffers[self.metric_path]
 
+    if datapoints:
+      state.events.metricsGenerated(datapoints)
+      state.instrumentation.increment('aggregateDatapointsSent', len(datapoints))
+
   def close(self):
     if self.compute_task and self.compute_task.running:
       self.compute_task.stop()
@@ -4,6 +4,7 @@ from os.path import exists, getmtime
 from twisted.internet.task import LoopingCall
 from carbon import log
 from carbon.aggregator.buffers import BufferManager
+from carbon.util import intern_name
 
 
 class RuleManager:
@@ -89,7 +90,7 @@ class AggregationRule:
     if match:
       extracted_fields = match.groupdict()
       try:
-        result = self.output_template % extracted_fields
+        result = intern_name(self.output_template % extracted_fields)
       except TypeError:
         log.err("Failed to interpolate template %s with fields %s" % (self.output_template, extracted_fields))
 
@@ -52,6 +52,7 @@ except:
 import carbon.protocols #satisfy import order requirements
 from carbon.conf import settings
 from carbon import log, events, instrumentation
+from carbon.util import intern_name
 
 
 HOSTNAME = socket.gethostname().split('.')[0]
@@ -109,6 +110,7 @@ class AMQPGraphiteProtocol(AMQClient):
             log.listener("Message received: %s" % (message,))
 
         metric = message.routing_key
+        metrics = []
 
         for line in message.content.body.split("\n"):
             line = line.strip()
@@ -126,12 +128,15 @@ class AMQPGraphiteProtocol(AMQClient):
                 log.listener("invalid message line: %s" % (line,))
                 continue
 
-            events.metricReceived(metric, datapoint)
+            metrics.append((intern_name(metric), datapoint))
 
             if self.factory.verbose:
                 log.listener("Metric posted: %s %s %s" %
                              (metric, value, timestamp,))
 
+        if metrics:
+            events.metricsReceived(metrics)
+
 
 class AMQPReconnectingFactory(ReconnectingClientFactory):
     """The reconnecting factory.
@@ -0,0 +1,259 @@
+"""Copyright 2009 Chris Davis
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+
+import time
+import threading
+from errno import ENOENT
+from os.path import dirname
+
+import whisper
+from carbon.conf import settings
+from carbon.storage import getFilesystemPath, DirtyFiles, KnownDirectories, KnownFiles, \
+    OpenFiles
+from carbon.util import PluginRegistrar
+from carbon import instrumentation, log
+
+try:
+  import fcntl
+except ImportError:
+  fcntl = None  # whisper.LOCK is never enabled without it
+
+
+class StorageBackend(object):
+  """Where the writer stores datapoints. Subclasses defining a plugin_name
+  can be selected with the STORAGE_BACKEND setting. Datapoints are passed as
+  lists of (timestamp, value) sorted by timestamp, and an update for a metric
+  that does not exist must raise an IOError with errno ENOENT."""
+  __metaclass__ = PluginRegistrar
+  plugins = {}
+
+  def start(self):
+    "override me if you want"
+
+  def stop(self):
+    "override me if you want"
+
+  def exists(self, metric):
+    raise NotImplementedError()
+
+  def create(self, metric, archiveConfig, xFilesFactor=None, aggregationMethod=None):
+    raise NotImplementedError()
+
+  def update_many(self, metric, datapoints):
+    raise NotImplementedError()
+
+  def get_metadata(self, metric, key):
+    raise NotImplementedError()
+
+  def set_metadata(self, metric, key, value):
+    """Returns the previous value"""
+    raise NotImplementedError()
+
+
+class WhisperBackend(StorageBackend):
+  plugin_name = 'whisper'
+
+  def __init__(self):
+    self.known_files = KnownFiles()
+    self.known_directories = KnownDirectories(settings.DIRECTORY_CACHE_SIZE)
+    self.dirty_files = None
+    if settings.WHISPER_SYNC_INTERVAL:
+      self.dirty_files = DirtyFiles()
+
+  def start(self):
+    from twisted.internet import reactor
+    if settings.SCAN_DATA_DIR_ON_STARTUP:
+      reactor.callInThread(self.known_files.scan, settings.LOCAL_DATA_DIR)
+    if self.dirty_files is not None and settings.WHISPER_SYNC_THREAD:
+      reactor.callInThread(self._syncForever)
+
+  def stop(self):
+    if self.dirty_files is not None:
+      self.sync()
+    OpenFiles.close_all()
+
+  def sync(self):
+    t1 = time.time()
+    count = self.dirty_files.sync()
+    if count:
+      instrumentation.append('syncTimes', time.time() - t1)
+      instrumentation.increment('syncedFiles', count)
+
+  def _syncForever(self):
+    from twisted.internet import reactor
+    while reactor.running:
+      self.dirty_files.ready.wait(settings.WHISPER_SYNC_INTERVAL)
+      try:
+        self.sync()
+      except Exception:
+        log.err()
+
+  def exists(self, metric):
+    return self.known_files.exists(metric, getFilesystemPath(metric))
+
+  def create(self, metric, archiveConfig, xFilesFactor=None, aggregationMethod=None):
+    dbFilePath = getFilesystemPath(metric)
+    dbDir = dirname(dbFilePath)
+    log.creates("creating database file %s (archive=%s xff=%s agg=%s)" %
+                (dbFilePath, archiveConfig, xFilesFactor, aggregationMethod))
+    try:
+      self._create_file(dbDir, dbFilePath, archiveConfig, xFilesFactor, aggregationMethod)
+    except (IOError, OSError), e:
+      if e.errno != ENOENT:
+        raise
+      # The directory was removed since it was cached, so make it again
+      self.known_directories.discard(dbDir)
+      self._create_file(dbDir, dbFilePath, archiveConfig, xFilesFactor, aggregationMethod)
+    self.known_files.add(metric)
+
+  def _create_file(self, dbDir, dbFilePath, archiveConfig, xFilesFactor, aggregationMethod):
+    try:
+      self.known_directories.ensure(dbDir)
+    except OSError, e:
+      log.err("%s" % e)
+    whisper.create(
+      dbFilePath,
+      archiveConfig,
+      xFilesFactor,
+      aggregationMethod,
+      settings.WHISPER_SPARSE_CREATE,
+      settings.WHISPER_FALLOCATE_CREATE)
+
+  def update_many(self, metric, datapoints):
+    dbFilePath = getFilesystemPath(metric)
+    try:
+      if OpenFiles._capacity():
+        self._update_open_file(dbFilePath, datapoints)
+      else:
+        whisper.update_many(dbFilePath, datapoints)
+    except (IOError, OSError), e:
+      if e.errno == ENOENT:
+        self.known_files.discard(metric)
+      raise
+    if self.dirty_files is not None:
+      if self.dirty_files.add(dbFilePath) and not settings.WHISPER_SYNC_THREAD:
+        self.sync()
+
+  def _update_open_file(self, dbFilePath, datapoints):
+    entry = OpenFiles.checkout(dbFilePath)
+    try:
+      fh = entry[0]
+      # whisper expects the newest datapoint first
+      whisper.file_update_many(fh, datapoints[::-1])
+      fh.flush()
+      if whisper.LOCK:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+    except:
+      OpenFiles.close(dbFilePath, entry)
+      raise
+    OpenFiles.checkin(dbFilePath, entry)
+
+  def get_metadata(self, metric, key):
+    return whisper.info(getFilesystemPath(metric))[key]
+
+  def set_metadata(self, metric, key, value):
+    wsp_path = getFilesystemPath(metric)
+    old_value = whisper.setAggregationMethod(wsp_path, value)
+    OpenFiles.invalidate(wsp_path)
+    return old_value
+
+
+class NullBackend(StorageBackend):
+  """Discards all datapoints, for measuring everything above the disk. Each
+  metric is still created once."""
+  plugin_name = 'null'
+
+  def __init__(self):
+    self.metrics = set()
+
+  def exists(self, metric):
+    return metric in self.metrics
+
+  def create(self, metric, archiveConfig, xFilesFactor=None, aggregationMethod=None):
+    self.metrics.add(metric)
+
+  def update_many(self, metric, datapoints):
+    if metric not in self.metrics:
+      raise IOError(ENOENT, "No such metric", metric)
+
+  def get_metadata(self, metric, key):
+    if metric not in self.metrics:
+      raise IOError(ENOENT, "No such metric", metric)
+    return None
+
+  def set_metadata(self, metric, key, value):
+    return self.get_metadata(metric, key)
+
+
+class MemoryBackend(StorageBackend):
+  """Keeps the datapoints of each metric in memory for testing without disk
+  I/O. Datapoints are kept at the resolution of the finest archive, for about
+  as long as the longest one retains them, and are not aggregated."""
+  plugin_name = 'memory'
+
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.series = {}  # { metric : (metadata, { timestamp : value }) }
+
+  def exists(self, metric):
+    return metric in self.series
+
+  def create(self, metric, archiveConfig, xFilesFactor=None, aggregationMethod=None):
+    step = min(secondsPerPoint for (secondsPerPoint, points) in archiveConfig)
+    retention = max(secondsPerPoint * points for (secondsPerPoint, points) in archiveConfig)
+    metadata = {
+      'archives': archiveConfig,
+      'step': step,
+      'retention': retention,
+      'maxPoints': retention // step,
+      'xFilesFactor': xFilesFactor,
+      'aggregationMethod': aggregationMethod,
+    }
+    with self.lock:
+      self.series[metric] = (metadata, {})
+
+  def _get(self, metric):
+    try:
+      return self.series[metric]
+    except KeyError:
+      raise IOError(ENOENT, "No such metric", metric)
+
+  def fetch(self, metric):
+    """Returns the stored datapoints of metric, sorted by timestamp"""
+    with self.lock:
+      return sorted(self._get(metric)[1].items())
+
+  def update_many(self, metric, datapoints):
+    with self.lock:
+      metadata, points = self._get(metric)
+      step = metadata['step']
+      for timestamp, value in datapoints:
+        timestamp = int(timestamp)
+        points[timestamp - timestamp % step] = value
+      # Allow some slack so that expiring points is amortized
+      if len(points) > metadata['maxPoints'] * 1.1 + 1:
+        oldest = max(points) - metadata['retention']
+        for timestamp in [t for t in points if t <= oldest]:
+          del points[timestamp]
+
+  def get_metadata(self, metric, key):
+    with self.lock:
+      return self._get(metric)[0][key]
+
+  def set_metadata(self, metric, key, value):
+    with self.lock:
+      metadata = self._get(metric)[0]
+      old_value = metadata[key]
+      metadata[key] = value
+      return old_value
@@ -13,7 +13,12 @@ See the License for the specific language governing permissions and
 limitations under the License."""
 
 import time
-from operator import itemgetter
+import threading
+from array import array
+from sys import getsizeof
+from bisect import bisect_left
+from collections import OrderedDict
+from heapq import heapify, heappop, heappush
 from random import choice
 
 from carbon.conf import settings
@@ -29,29 +34,177 @@ class CacheFeedingProcessor(Processor):
   plugin_name = 'write'
 
   def process(self, metric, datapoint):
+    if state.cache_wal:
+      state.cache_wal.write(metric, datapoint)
     MetricCache.store(metric, datapoint)
     return Processor.NO_OUTPUT
 
+  def process_batch(self, metrics):
+    wal = state.cache_wal
+    store = MetricCache.store
+    for metric, datapoint in metrics:
+      if wal:
+        wal.write(metric, datapoint)
+      store(metric, datapoint)
+    return Processor.NO_OUTPUT
+
+
+class _DatapointColumns(object):
+  """The cached datapoints of one metric, kept sorted by timestamp in two
+  parallel arrays. Timestamps arriving in order are simply appended; late
+  ones are inserted in place, so reads never need to sort. Timestamps are
+  stored with whisper's one second resolution."""
+  __slots__ = ('timestamps', 'values')
+
+  def __init__(self):
+    self.timestamps = array('l')
+    self.values = array('d')
+
+  def __len__(self):
+    return len(self.timestamps)
+
+  def _position(self, timestamp):
+    timestamps = self.timestamps
+    if not timestamps or timestamp > timestamps[-1]:
+      return len(timestamps)
+    return bisect_left(timestamps, timestamp)
+
+  def overwrite(self, timestamp, value):
+    """Replaces the value of an already cached timestamp. Returns False,
+    changing nothing, if the timestamp is not cached"""
+    timestamp = int(timestamp)
+    i = self._position(timestamp)
+    if i < len(self.timestamps) and self.timestamps[i] == timestamp:
+      self.values[i] = value
+      return True
+    return False
+
+  def add(self, timestamp, value):
+    """Caches a datapoint whose timestamp is not cached yet"""
+    timestamp = int(timestamp)
+    i = self._position(timestamp)
+    if i == len(self.timestamps):
+      self.timestamps.append(timestamp)
+      self.values.append(value)
+    else:
+      self.timestamps.insert(i, timestamp)
+      self.values.insert(i, value)
+
+  def items(self):
+    """Returns a list of (timestamp, value) tuples sorted by timestamp"""
+    return zip(self.timestamps, self.values)
+
+
+# Estimated memory used by each cached datapoint, and by each cache entry on
+# top of its name and datapoints: the columns object and its two arrays, plus
+# the entry's share of the cache dict and of the drain strategy's index.
+POINT_SIZE = array('l').itemsize + array('d').itemsize
+ENTRY_SIZE = getsizeof(_DatapointColumns()) + 2 * getsizeof(array('l')) + 3 * 48
+
+
+class _CountIndex(object):
+  """Metric names bucketed by their number of cached datapoints. Moving a
+  metric between buckets is O(1), and finding the largest bucket is amortized
+  O(1) because the max pointer only walks back down over counts that stores
+  previously walked it up through."""
+  def __init__(self):
+    self.buckets = {}  # { count : set(metrics) }
+    self.counts = {}  # { metric : count }
+    self.max_count = 0
+
+  def __len__(self):
+    return len(self.counts)
+
+  def __contains__(self, metric):
+    return metric in self.counts
+
+  def set(self, metric, count):
+    self.discard(metric)
+    self.counts[metric] = count
+    bucket = self.buckets.get(count)
+    if bucket is None:
+      bucket = self.buckets[count] = set()
+    bucket.add(metric)
+    if count > self.max_count:
+      self.max_count = count
+
+  def discard(self, metric):
+    count = self.counts.pop(metric, None)
+    if count is None:
+      return
+    bucket = self.buckets[count]
+    bucket.discard(metric)
+    if not bucket:
+      del self.buckets[count]
+
+  def pop_max(self):
+    """Removes and returns a (metric, count) pair with the greatest count, or
+    (None, 0) when the index is empty"""
+    if not self.counts:
+      self.max_count = 0
+      return (None, 0)
+    while self.max_count not in self.buckets:
+      self.max_count -= 1
+    count = self.max_count
+    bucket = self.buckets[count]
+    metric = bucket.pop()
+    if not bucket:
+      del self.buckets[count]
+    del self.counts[metric]
+    return (metric, count)
+
+  def peek_max(self):
+    """Returns a metric with the greatest count without removing it, or None
+    when the index is empty"""
+    # Popping and re-adding lets set.pop()'s finger find the member in O(1),
+    # where iterating a large, churned bucket would scan its empty slots.
+    metric, count = self.pop_max()
+    if metric is not None:
+      self.set(metric, count)
+    return metric
+
 
 class DrainStrategy(object):
   """Implements the strategy for writing metrics.
   The strategy chooses what order (if any) metrics
   will be popped from the backing cache"""
+  # If set, a function of the metric name whose result picks the metric's
+  # shard, for strategies that need related metrics kept in one shard
+  shard_key = None
+
   def __init__(self, cache):
     self.cache = cache
 
   def choose_item(self):
     raise NotImplemented
 
+  def metric_stored(self, metric, count):
+    "Called by a watched cache when a new datapoint brings metric to count"
+
+  def metric_popped(self, metric):
+    "Called by a watched cache when metric and its datapoints are removed"
+
 
 class MaxStrategy(DrainStrategy):
   """Always pop the metric with the greatest number of points stored.
   This method leads to less variance in pointsPerUpdate but may mean
   that infrequently or irregularly updated metrics may not be written
   until shutdown """
+  def __init__(self, cache):
+    super(MaxStrategy, self).__init__(cache)
+    self.index = _CountIndex()
+    for metric, count in cache.counts:
+      self.index.set(metric, count)
+    cache.watch(self)
+
+  def metric_stored(self, metric, count):
+    self.index.set(metric, count)
+
+  def metric_popped(self, metric):
+    self.index.discard(metric)
+
   def choose_item(self):
-    metric_name, size = max(self.cache.items(), key=lambda x: len(itemgetter(1)(x)))
-    return metric_name
+    return self.index.peek_max()
 
 
 class RandomStrategy(DrainStrategy):
@@ -66,25 +219,152 @@ class SortedStrategy(DrainStrategy):
   a loop of the cache """
   def __init__(self, cache):
     super(SortedStrategy, self).__init__(cache)
+    # Metrics not yet drained during this loop, and metrics that have to wait
+    # for the next one because they were chosen or first stored mid-loop.
+    self.current = _CountIndex()
+    self.next = _CountIndex()
+    for metric, count in cache.counts:
+      self.current.set(metric, count)
+    cache.watch(self)
+
+  def metric_stored(self, metric, count):
+    if metric in self.current:
+      self.current.set(metric, count)
+    else:
+      self.next.set(metric, count)
 
-    def _generate_queue():
-      while True:
-        t = time.time()
-        metric_counts = sorted(self.cache.counts, key=lambda x: x[1])
-        log.debug("Sorted %d cache queues in %.6f seconds" % (len(metric_counts), time.time() - t))
-        while metric_counts:
-          yield itemgetter(0)(metric_counts.pop())
+  def metric_popped(self, metric):
+    self.current.discard(metric)
+    self.next.discard(metric)
 
-    self.queue = _generate_queue()
+  def choose_item(self):
+    if not self.current:
+      self.current, self.next = self.next, self.current
+      log.debug("Starting a new drain loop over %d cache queues" % len(self.current))
+    metric, count = self.current.pop_max()
+    if metric is not None:
+      self.next.set(metric, count)
+    return metric
+
+
+class LocalityStrategy(SortedStrategy):
+  """Like the sorted strategy, writes every metric once per loop of the cache,
+  but once it has chosen the fullest metric it goes on to the other metrics
+  of the same parent (those whose database files share a directory) before
+  choosing the next fullest. Consecutive writes then stay within a directory,
+  which keeps its entries cached and reduces seeks on spinning disks."""
+  def __init__(self, cache):
+    self.groups = {}  # { parent : set(metrics not yet drained this loop) }
+    self.parent = None  # Parent of the metrics being drained
+    super(LocalityStrategy, self).__init__(cache)
+    self._build_groups()
+
+  @staticmethod
+  def parent_of(metric):
+    return metric.rpartition('.')[0]
+
+  shard_key = parent_of
+
+  def _build_groups(self):
+    groups = self.groups = {}
+    parent_of = self.parent_of
+    for metric in self.current.counts:
+      parent = parent_of(metric)
+      group = groups.get(parent)
+      if group is None:
+        group = groups[parent] = set()
+      group.add(metric)
+
+  def _ungroup(self, metric):
+    parent = self.parent_of(metric)
+    group = self.groups.get(parent)
+    if group is not None:
+      group.discard(metric)
+      if not group:
+        del self.groups[parent]
+
+  def metric_popped(self, metric):
+    if metric in self.current:
+      self._ungroup(metric)
+    super(LocalityStrategy, self).metric_popped(metric)
 
   def choose_item(self):
-    return self.queue.next()
+    if not self.current:
+      self.current, self.next = self.next, self.current
+      self._build_groups()
+      log.debug("Starting a new drain loop over %d cache queues" % len(self.current))
+
+    group = self.groups.get(self.parent)
+    if group:
+      metric = group.pop()
+      if not group:
+        del self.groups[self.parent]
+      count = self.current.counts[metric]
+      self.current.discard(metric)
+    else:
+      metric, count = self.current.pop_max()
+      if metric is None:
+        return None
+      self.parent = self.parent_of(metric)
+      self._ungroup(metric)
+    self.next.set(metric, count)
+    return metric
+
+
+class TimeSortedStrategy(DrainStrategy):
+  """Pop the metric whose datapoints have waited longest in the cache, which
+  bounds how long points stay unwritten. If CACHE_WRITE_MAX_AGE is set, the
+  fullest metric is preferred for as long as no metric has waited longer than
+  that many seconds."""
+  def __init__(self, cache):
+    super(TimeSortedStrategy, self).__init__(cache)
+    self.since = {}  # { metric : time its oldest unwritten point was cached }
+    self.heap = []  # (since, metric) pairs, including stale ones
+    self.index = _CountIndex()
+    now = time.time()
+    for metric, count in cache.counts:
+      self.since[metric] = now
+      self.heap.append((now, metric))
+      self.index.set(metric, count)
+    cache.watch(self)
+
+  def metric_stored(self, metric, count):
+    self.index.set(metric, count)
+    if count == 1:
+      now = time.time()
+      self.since[metric] = now
+      heappush(self.heap, (now, metric))
+
+  def metric_popped(self, metric):
+    self.index.discard(metric)
+    del self.since[metric]
+    # Popped entries are left in the heap until they surface; rebuild it
+    # rather than let them pile up behind a long-lived entry.
+    if len(self.heap) > 2 * len(self.since) + 1024:
+      self.heap = [(since, name) for (name, since) in self.since.iteritems()]
+      heapify(self.heap)
+
+  def choose_item(self):
+    heap = self.heap
+    while heap and self.since.get(heap[0][1]) != heap[0][0]:
+      heappop(heap)
+    if not heap:
+      return None
+    since, metric = heap[0]
+    max_age = settings.CACHE_WRITE_MAX_AGE
+    if max_age and time.time() - since < max_age:
+      return self.index.peek_max()
+    return metric
 
 
 class _MetricCache(dict):
-  """A Singleton dictionary of metric names and lists of their datapoints"""
+  """A Singleton dictionary of metric names and `_DatapointColumns`_ of their
+  datapoints"""
   def __init__(self, strategy=None):
+    self.lock = threading.Lock()
     self.size = 0
+    self.bytes = 0
+    self.observers = []
     self.strategy = None
     if strategy:
       self.strategy = strategy(self)
@@ -92,21 +372,23 @@ class _MetricCache(dict):
   def __setitem__(self, key, value):
     raise TypeError("Use store() method instead!")
 
+  def watch(self, observer):
+    """Registers an object (usually a `DrainStrategy`_) whose metric_stored()
+    and metric_popped() methods are called, with the cache lock held, as the
+    contents of the cache change, as is its metric_restored() method, if it
+    has one, after restore()"""
+    self.observers.append(observer)
+
   @property
   def counts(self):
     return [(metric, len(datapoints)) for (metric, datapoints) in self.items()]
 
   @property
   def is_full(self):
-    if settings.MAX_CACHE_SIZE == float('inf'):
-      return False
-    else:
-      return self.size >= settings.MAX_CACHE_SIZE
+    return _is_full(self)
 
   def _check_available_space(self):
-    if state.cacheTooFull and self.size < settings.CACHE_SIZE_LOW_WATERMARK:
-      log.msg("cache size below watermark")
-      events.cacheSpaceAvailable()
+    _check_space(self)
 
   def drain_metric(self):
     """Returns a metric and it's datapoints in order determined by the
@@ -114,7 +396,8 @@ class _MetricCache(dict):
     if not self:
       return (None, [])
     if self.strategy:
-      metric = self.strategy.choose_item()
+      with self.lock:
+        metric = self.strategy.choose_item()
     else:
       # Avoid .keys() as it dumps the whole list
       metric = self.iterkeys().next()
@@ -122,41 +405,322 @@ class _MetricCache(dict):
 
   def get_datapoints(self, metric):
     """Return a list of currently cached datapoints sorted by timestamp"""
-    return sorted(self.get(metric, {}).items(), key=by_timestamp)
+    datapoints = self.get(metric)
+    if datapoints is None:
+      return []
+    return datapoints.items()
 
   def pop(self, metric):
-    datapoint_index = dict.pop(self, metric)
-    self.size -= len(datapoint_index)
+    with self.lock:
+      datapoints = dict.pop(self, metric)
+      self.size -= len(datapoints)
+      self.bytes -= ENTRY_SIZE + getsizeof(metric) + len(datapoints) * POINT_SIZE
+      for observer in self.observers:
+        observer.metric_popped(metric)
     self._check_available_space()
 
-    return sorted(datapoint_index.items(), key=by_timestamp)
-
-  def store(self, metric, datapoint):
-    self.setdefault(metric, {})
+    return datapoints.items()
+
+  def restore(self, metric, datapoints):
+    """Puts back datapoints taken from the cache that could not be written,
+    even if the cache is full"""
+    for datapoint in datapoints:
+      self.store(metric, datapoint, force=True)
+    with self.lock:
+      for observer in self.observers:
+        restored = getattr(observer, 'metric_restored', None)
+        if restored is not None:
+          restored(metric)
+
+  def store(self, metric, datapoint, force=False):
+    """Caches a datapoint, unless the cache is full, in which case it is handed
+    to the overflow file if one is enabled and dropped otherwise. With force,
+    datapoints are cached even then, e.g. when restoring the cache at startup"""
     timestamp, value = datapoint
-    if timestamp not in self[metric]:
+    with self.lock:
+      datapoints = self.get(metric)
+      if datapoints is not None and datapoints.overwrite(timestamp, value):
+        # Updating a duplicate does not increase the cache size
+        return
       # Not a duplicate, hence process if cache is not full
-      if self.is_full:
-        log.msg("MetricCache is full: self.size=%d" % self.size)
-        events.cacheFull()
-      else:
+      full = not force and self.is_full
+      if not full:
+        if datapoints is None:
+          datapoints = dict.setdefault(self, metric, _DatapointColumns())
+          self.bytes += ENTRY_SIZE + getsizeof(metric)
         self.size += 1
-        self[metric][timestamp] = value
-    else:
-      # Updating a duplicate does not increase the cache size
-      self[metric][timestamp] = value
+        self.bytes += POINT_SIZE
+        datapoints.add(timestamp, value)
+        count = len(datapoints)
+        for observer in self.observers:
+          observer.metric_stored(metric, count)
+
+    if full:
+      overflow = state.cache_overflow
+      if overflow is None or not overflow.write(metric, datapoint):
+        log.msg("MetricCache is full: self.size=%d self.bytes=%d" % (self.size, self.bytes))
+      events.cacheFull()
+
+
+class _MetricCacheShard(_MetricCache):
+  """One partition of a `_ShardedMetricCache`_. Fullness and the low watermark
+  are judged against the whole cache rather than the shard alone."""
+  def __init__(self, parent, strategy=None):
+    self.parent = parent
+    super(_MetricCacheShard, self).__init__(strategy)
+
+  @property
+  def is_full(self):
+    return self.parent.is_full
+
+  def _check_available_space(self):
+    self.parent._check_available_space()
 
 
+class _ShardGroup(object):
+  """A set of cache shards that are drained together by one writer thread"""
+  def __init__(self, shards):
+    self.shards = shards
+    self.next_shard = 0
+
+  def __len__(self):
+    return sum(len(shard) for shard in self.shards)
+
+  def __nonzero__(self):
+    return any(self.shards)
+
+  @property
+  def size(self):
+    return sum(shard.size for shard in self.shards)
+
+  @property
+  def bytes(self):
+    return sum(shard.bytes for shard in self.shards)
+
+  @property
+  def counts(self):
+    return [count for shard in self.shards for count in shard.counts]
+
+  def drain_metric(self):
+    """Drains a metric from each non-empty shard in turn, so that a busy shard
+    cannot starve the others"""
+    for _i in range(len(self.shards)):
+      shard = self.shards[self.next_shard]
+      self.next_shard = (self.next_shard + 1) % len(self.shards)
+      if shard:
+        return shard.drain_metric()
+    return (None, [])
+
+
+class _ShardedMetricCache(_ShardGroup):
+  """The metric cache, split by metric name hash across `_MetricCacheShard`_
+  instances that each have their own lock and drain strategy. Every metric
+  lives in exactly one shard, so writer threads draining disjoint sets of
+  shards never write the same database file."""
+  def __init__(self, strategy=None, shard_count=1):
+    super(_ShardedMetricCache, self).__init__([])
+    self._build_shards(strategy, shard_count)
+
+  def _build_shards(self, strategy, shard_count):
+    old_shards = self.shards
+    self.shards = [_MetricCacheShard(self, strategy) for _i in range(max(1, int(shard_count)))]
+    self.shard_key = strategy and strategy.shard_key
+    self.next_shard = 0
+    for shard in old_shards:
+      for metric, datapoints in shard.items():
+        for datapoint in datapoints.items():
+          self.store(metric, datapoint)
+
+  def configure(self):
+    """Rebuilds the shards from the current settings. This module is imported
+    before the configuration file has been read, so this must be called once
+    it has, before the writer threads start."""
+    strategy = WRITE_STRATEGIES.get(settings.CACHE_WRITE_STRATEGY)
+    shard_count = max(settings.CACHE_SHARDS, settings.WRITER_THREADS)
+    self._build_shards(strategy, shard_count)
+
+  def shard_for(self, metric):
+    if self.shard_key:
+      return self.shards[hash(self.shard_key(metric)) % len(self.shards)]
+    return self.shards[hash(metric) % len(self.shards)]
+
+  def partition(self, count):
+    """Splits the shards into count `_ShardGroup`_ instances, one per writer
+    thread"""
+    return [_ShardGroup(self.shards[i::count]) for i in range(count)]
+
+  def __contains__(self, metric):
+    return metric in self.shard_for(metric)
+
+  @property
+  def is_full(self):
+    return _is_full(self)
+
+  def _check_available_space(self):
+    _check_space(self)
+
+  def get_datapoints(self, metric):
+    """Return a list of currently cached datapoints sorted by timestamp"""
+    return self.shard_for(metric).get_datapoints(metric)
+
+  def pop(self, metric):
+    return self.shard_for(metric).pop(metric)
+
+  def restore(self, metric, datapoints):
+    self.shard_for(metric).restore(metric, datapoints)
+
+  def store(self, metric, datapoint, force=False):
+    self.shard_for(metric).store(metric, datapoint, force)
+
+
+class _CreateBacklog(object):
+  """Metrics whose database file could not be created yet because of
+  MAX_CREATES_PER_MINUTE, with their datapoints, in the order they were
+  deferred. Datapoints drained for a metric that is still queued, or whose
+  file is being created, are merged into its entry. At most
+  MAX_CREATE_BACKLOG datapoints are held."""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.pending = OrderedDict()  # { metric : _DatapointColumns }
+    self.creating = {}  # { metric : _DatapointColumns } of late datapoints
+    self.size = 0
+    self.observers = []
+
+  def watch(self, observer):
+    """Registers an object whose metric_deferred() and metric_released()
+    methods are called, with the lock held, when a metric is queued and once
+    the backlog no longer holds any of its datapoints"""
+    self.observers.append(observer)
+
+  def __len__(self):
+    return len(self.pending)
+
+  def __contains__(self, metric):
+    return metric in self.pending or metric in self.creating
+
+  def add(self, metric, datapoints):
+    """Queues datapoints for metric, returning how many of them were dropped
+    because the backlog is full"""
+    with self.lock:
+      return self._add(metric, datapoints, True)
+
+  def merge(self, metric, datapoints):
+    """Adds datapoints to the entry of metric if it is queued or being
+    created, returning None if it is neither and otherwise as add() does.
+    Checking and adding under one lock keeps a concurrent finish(metric) from
+    getting the metric queued a second time."""
+    with self.lock:
+      return self._add(metric, datapoints, False)
+
+  def _add(self, metric, datapoints, queue):
+    columns = self.creating.get(metric)
+    if columns is None:
+      columns = self.pending.get(metric)
+    if columns is None:
+      if not queue:
+        return None
+      if self.size >= settings.MAX_CREATE_BACKLOG:
+        return len(datapoints)
+      columns = self.pending[metric] = _DatapointColumns()
+      for observer in self.observers:
+        observer.metric_deferred(metric)
+    for i, (timestamp, value) in enumerate(datapoints):
+      if columns.overwrite(timestamp, value):
+        continue
+      if self.size >= settings.MAX_CREATE_BACKLOG:
+        return len(datapoints) - i
+      columns.add(timestamp, value)
+      self.size += 1
+    return 0
+
+  def pop(self):
+    """Takes the longest-queued metric, returning (metric, datapoints) or
+    (None, []). Its datapoints arriving until finish(metric) ends its creation
+    are held back, since its file is about to be created."""
+    with self.lock:
+      if not self.pending:
+        return (None, [])
+      metric, columns = self.pending.popitem(last=False)
+      self.size -= len(columns)
+      self.creating[metric] = _DatapointColumns()
+      return (metric, columns.items())
+
+  def finish(self, metric):
+    """Returns the datapoints of metric that arrived while it was being
+    created, to be written by the caller. Its creation only ends once there
+    are none left, so that finish() is called until it returns []."""
+    with self.lock:
+      columns = self.creating.get(metric)
+      if columns is None:
+        return []
+      self.size -= len(columns)
+      if columns:
+        self.creating[metric] = _DatapointColumns()
+      else:
+        del self.creating[metric]
+        for observer in self.observers:
+          observer.metric_released(metric)
+      return columns.items()
+
+  def abort(self, metric, requeue):
+    """Ends the creation of metric's file whether or not it succeeded, handing
+    the datapoints that arrived in the meantime to requeue(metric, datapoints)
+    before the observers are told that the backlog has let go of them"""
+    with self.lock:
+      columns = self.creating.pop(metric, None)
+      if columns is None:
+        return
+      self.size -= len(columns)
+      if columns:
+        requeue(metric, columns.items())
+      for observer in self.observers:
+        observer.metric_released(metric)
+
+  def drain(self):
+    """Takes every queued metric, returning a list of (metric, datapoints).
+    Metrics being created are left to their create threads."""
+    with self.lock:
+      entries = []
+      while self.pending:
+        metric, columns = self.pending.popitem(last=False)
+        self.size -= len(columns)
+        for observer in self.observers:
+          observer.metric_released(metric)
+        entries.append((metric, columns.items()))
+      return entries
+
+
+def _is_full(cache):
+  """A cache is full once either its datapoint count or its estimated memory
+  use reaches the configured limit"""
+  if settings.MAX_CACHE_SIZE != float('inf') and cache.size >= settings.MAX_CACHE_SIZE:
+    return True
+  if settings.MAX_CACHE_MEMORY != float('inf') and cache.bytes >= settings.MAX_CACHE_MEMORY:
+    return True
+  return False
+
+
+def _check_space(cache):
+  """Lifts flow control once a full cache is back below both low watermarks"""
+  if (state.cacheTooFull and
+      cache.size < settings.CACHE_SIZE_LOW_WATERMARK and
+      cache.bytes < settings.CACHE_MEMORY_LOW_WATERMARK):
+    log.msg("cache size below watermark")
+    events.cacheSpaceAvailable()
+
+
+WRITE_STRATEGIES = {
+  'max': MaxStrategy,
+  'sorted': SortedStrategy,
+  'random': RandomStrategy,
+  'timesorted': TimeSortedStrategy,
+  'locality': LocalityStrategy,
+}
+
 # Initialize a singleton cache instance
-write_strategy = None
-if settings.CACHE_WRITE_STRATEGY == 'max':
-  write_strategy = MaxStrategy
-if settings.CACHE_WRITE_STRATEGY == 'sorted':
-  write_strategy = SortedStrategy
-if settings.CACHE_WRITE_STRATEGY == 'random':
-  write_strategy = RandomStrategy
-
-MetricCache = _MetricCache(write_strategy)
+MetricCache = _ShardedMetricCache()
+MetricCache.configure()
+CreateBacklog = _CreateBacklog()
 
 # Avoid import circularities
 from carbon import state
@@ -7,7 +7,7 @@ from twisted.internet.defer import Deferred, DeferredList
 from twisted.internet.protocol import ReconnectingClientFactory
 from twisted.protocols.basic import Int32StringReceiver
 from carbon.conf import settings
-from carbon.util import pickle
+from carbon.util import pickle, encode_binary
 from carbon import instrumentation, log, pipeline, state
 
 try:
@@ -63,7 +63,10 @@ class CarbonClientProtocol(Int32StringReceiver):
     reactor.callLater(settings.TIME_TO_DEFER_SENDING, self.sendQueued)
 
   def _sendDatapoints(self, datapoints):
-      self.sendString(pickle.dumps(datapoints, protocol=-1))
+      if settings.DESTINATION_PROTOCOL == 'binary':
+        self.sendString(encode_binary(datapoints))
+      else:
+        self.sendString(pickle.dumps(datapoints, protocol=-1))
       instrumentation.increment(self.sent, len(datapoints))
       instrumentation.increment(self.batchesSent)
       self.factory.checkQueue()
@@ -265,6 +268,25 @@ class CarbonClientFactory(ReconnectingClientFactory):
     else:
       instrumentation.increment(self.queuedUntilConnected)
 
+  def sendDatapoints(self, datapoints):
+    """Queues a list of (metric, datapoint) pairs like sendDatapoint() does,
+    scheduling a single send for all of them"""
+    count = len(datapoints)
+    instrumentation.increment(self.attemptedRelays, count)
+    instrumentation.max(self.relayMaxQueueLength, self.queueSize)
+    space = max(0, settings.MAX_QUEUE_SIZE - self.queueSize)
+    if count > space:
+      if not self.queueFull.called:
+        self.queueFull.callback(self.queueSize)
+      instrumentation.increment(self.fullQueueDrops, count - space)
+      datapoints = datapoints[:space]
+    self.queue.extend(datapoints)
+
+    if self.connectedProtocol:
+      reactor.callLater(settings.TIME_TO_DEFER_SENDING, self.connectedProtocol.sendQueued)
+    else:
+      instrumentation.increment(self.queuedUntilConnected, count)
+
   def sendHighPriorityDatapoint(self, metric, datapoint):
     """The high priority datapoint is one relating to the carbon
     daemon itself.  It puts the datapoint on the left of the deque,
@@ -379,6 +401,20 @@ class CarbonClientManager(Service):
     for destination in self.router.getDestinations(metric):
       self.client_factories[destination].sendDatapoint(metric, datapoint)
 
+  def sendDatapoints(self, datapoints):
+    """Routes a list of (metric, datapoint) pairs, handing each destination
+    its share in one call"""
+    batches = {}
+    getDestinations = self.router.getDestinations
+    for metric, datapoint in datapoints:
+      for destination in getDestinations(metric):
+        batch = batches.get(destination)
+        if batch is None:
+          batch = batches[destination] = []
+        batch.append((metric, datapoint))
+    for destination, batch in batches.iteritems():
+      self.client_factories[destination].sendDatapoints(batch)
+
   def sendHighPriorityDatapoint(self, metric, datapoint):
     for destination in self.router.getDestinations(metric):
       self.client_factories[destination].sendHighPriorityDatapoint(metric, datapoint)
@@ -393,3 +429,7 @@ class RelayProcessor(pipeline.Processor):
   def process(self, metric, datapoint):
     state.client_manager.sendDatapoint(metric, datapoint)
     return pipeline.Processor.NO_OUTPUT
+
+  def process_batch(self, metrics):
+    state.client_manager.sendDatapoints(metrics)
+    return pipeline.Processor.NO_OUTPUT
@@ -28,11 +28,27 @@ from carbon.exceptions import CarbonConfigException
 from twisted.python import usage
 
 
+# Set in the environment of the receiver worker processes started by a
+# carbon-relay or carbon-aggregator with RECEIVER_PROCESSES, to their index
+RECEIVER_WORKER_ENV = 'CARBON_RECEIVER_WORKER'
+
 defaults = dict(
   USER="",
   MAX_CACHE_SIZE=float('inf'),
+  MAX_CACHE_MEMORY=float('inf'),
+  CACHE_SIZE_LOW_WATERMARK=float('inf'),
+  CACHE_MEMORY_LOW_WATERMARK=float('inf'),
   MAX_UPDATES_PER_SECOND=500,
+  ENABLE_UPDATE_RATE_CONTROL=False,
+  MIN_UPDATES_PER_SECOND=10,
+  UPDATE_LATENCY_TARGET=0.05,
+  UPDATE_RATE_CACHE_SETPOINT=0,
   MAX_CREATES_PER_MINUTE=float('inf'),
+  SCHEMA_CACHE_SIZE=100000,
+  SCAN_DATA_DIR_ON_STARTUP=True,
+  DIRECTORY_CACHE_SIZE=100000,
+  STORAGE_BACKEND='whisper',
+  MAX_CREATE_BACKLOG=1000000,
   LINE_RECEIVER_INTERFACE='0.0.0.0',
   LINE_RECEIVER_PORT=2003,
   ENABLE_UDP_LISTENER=False,
@@ -40,14 +56,21 @@ defaults = dict(
   UDP_RECEIVER_PORT=2003,
   PICKLE_RECEIVER_INTERFACE='0.0.0.0',
   PICKLE_RECEIVER_PORT=2004,
+  BINARY_RECEIVER_INTERFACE='0.0.0.0',
+  BINARY_RECEIVER_PORT=0,
   CACHE_QUERY_INTERFACE='0.0.0.0',
   CACHE_QUERY_PORT=7002,
   LOG_UPDATES=True,
   LOG_CACHE_HITS=True,
   WHISPER_AUTOFLUSH=False,
+  WHISPER_SYNC_INTERVAL=0,
+  WHISPER_SYNC_MAX_DIRTY_FILES=1000,
+  WHISPER_SYNC_THREAD=True,
   WHISPER_SPARSE_CREATE=False,
   WHISPER_FALLOCATE_CREATE=False,
   WHISPER_LOCK_WRITES=False,
+  MAX_OPEN_DATABASE_FILES=0,
+  OPEN_DATABASE_FILE_MAX_AGE=60,
   MAX_DATAPOINTS_PER_MESSAGE=500,
   MAX_AGGREGATION_INTERVALS=5,
   MAX_QUEUE_SIZE=1000,
@@ -64,12 +87,25 @@ defaults = dict(
   RELAY_METHOD='relay-rules',
   REPLICATION_FACTOR=1,
   DESTINATIONS=[],
+  DESTINATION_PROTOCOL='pickle',
+  RECEIVER_PROCESSES=1,
   USE_FLOW_CONTROL=True,
   USE_INSECURE_UNPICKLER=False,
   USE_WHITELIST=False,
   CARBON_METRIC_PREFIX='carbon',
   CARBON_METRIC_INTERVAL=60,
   CACHE_WRITE_STRATEGY='sorted',
+  CACHE_WRITE_MAX_AGE=0,
+  CACHE_SHARDS=1,
+  WRITER_THREADS=1,
+  CREATE_THREADS=1,
+  ENABLE_CACHE_WAL=False,
+  CACHE_WAL_SYNC_INTERVAL=1,
+  CACHE_WAL_MAX_SEGMENT_SIZE=64 * 1024 * 1024,
+  ENABLE_CACHE_FIND=False,
+  ENABLE_CACHE_OVERFLOW=False,
+  MAX_CACHE_OVERFLOW_SIZE=1024 * 1024 * 1024,
+  CACHE_OVERFLOW_MERGE_INTERVAL=1,
   WRITE_BACK_FREQUENCY=None,
   MIN_RESET_STAT_FLOW=1000,
   MIN_RESET_RATIO=0.9,
@@ -209,23 +245,41 @@ class CarbonCacheOptions(usage.Options):
         settings.update(program_settings)
         settings["program"] = program
 
+        # Flow control resumes receiving once the cache drains below 95% of
+        # its limits.
+        settings["CACHE_SIZE_LOW_WATERMARK"] = settings.MAX_CACHE_SIZE * 0.95
+        settings["CACHE_MEMORY_LOW_WATERMARK"] = settings.MAX_CACHE_MEMORY * 0.95
+
         # Normalize and expand paths
         settings["STORAGE_DIR"] = os.path.normpath(os.path.expanduser(settings["STORAGE_DIR"]))
         settings["LOCAL_DATA_DIR"] = os.path.normpath(os.path.expanduser(settings["LOCAL_DATA_DIR"]))
         settings["WHITELISTS_DIR"] = os.path.normpath(os.path.expanduser(settings["WHITELISTS_DIR"]))
         settings["PID_DIR"] = os.path.normpath(os.path.expanduser(settings["PID_DIR"]))
         settings["LOG_DIR"] = os.path.normpath(os.path.expanduser(settings["LOG_DIR"]))
+        settings["CACHE_WAL_DIR"] = os.path.normpath(os.path.expanduser(settings["CACHE_WAL_DIR"]))
+        settings["CACHE_OVERFLOW_DIR"] = os.path.normpath(
+            os.path.expanduser(settings["CACHE_OVERFLOW_DIR"]))
         settings["pidfile"] = os.path.normpath(os.path.expanduser(settings["pidfile"]))
 
-        # Set process uid/gid by changing the parent config, if a user was
-        # provided in the configuration file.
-        if settings.USER:
-            self.parent["uid"], self.parent["gid"] = (
-                pwd.getpwnam(settings.USER)[2:4])
+        # Receiver worker processes run in the foreground under their
+        # parent, which owns the pidfile and has already switched users.
+        receiver_worker = os.environ.get(RECEIVER_WORKER_ENV)
+        if receiver_worker is not None:
+            settings["receiver_worker"] = int(receiver_worker)
+            self.parent["nodaemon"] = True
+            self.parent["pidfile"] = ""
+        else:
+            settings["receiver_worker"] = None
+
+            # Set process uid/gid by changing the parent config, if a user was
+            # provided in the configuration file.
+            if settings.USER:
+                self.parent["uid"], self.parent["gid"] = (
+                    pwd.getpwnam(settings.USER)[2:4])
 
-        # Set the pidfile in parent config to the value that was computed by
-        # C{read_config}.
-        self.parent["pidfile"] = settings["pidfile"]
+            # Set the pidfile in parent config to the value that was computed by
+            # C{read_config}.
+            self.parent["pidfile"] = settings["pidfile"]
 
         storage_schemas = join(settings["CONF_DIR"], "storage-schemas.conf")
         if not exists(storage_schemas):
@@ -235,6 +289,8 @@ class CarbonCacheOptions(usage.Options):
         if settings.WHISPER_AUTOFLUSH:
             log.msg("Enabling Whisper autoflush")
             whisper.AUTOFLUSH = True
+            if settings.WHISPER_SYNC_INTERVAL:
+                log.msg("WHISPER_SYNC_INTERVAL has no effect with WHISPER_AUTOFLUSH enabled")
 
         if settings.WHISPER_FALLOCATE_CREATE:
             if whisper.CAN_FALLOCATE:
@@ -249,9 +305,15 @@ class CarbonCacheOptions(usage.Options):
             else:
                 log.err("WHISPER_LOCK_WRITES is enabled but import of fcntl module failed.")
 
+        if settings.MAX_OPEN_DATABASE_FILES:
+            # Headers of files kept open are dropped from the cache as the
+            # files are closed
+            whisper.CACHE_HEADERS = True
+
         if not "action" in self:
             self["action"] = "start"
-        self.handleAction()
+        if receiver_worker is None:
+            self.handleAction()
 
         # If we are not running in debug mode or non-daemon mode, then log to a
         # directory, otherwise log output will go to stdout. If parent options
@@ -548,6 +610,10 @@ def read_config(program, options, **kwargs):
         "LOCAL_DATA_DIR", join(settings["STORAGE_DIR"], "whisper"))
     settings.setdefault(
         "WHITELISTS_DIR", join(settings["STORAGE_DIR"], "lists"))
+    settings.setdefault(
+        "CACHE_WAL_DIR", join(settings["STORAGE_DIR"], "wal"))
+    settings.setdefault(
+        "CACHE_OVERFLOW_DIR", join(settings["STORAGE_DIR"], "overflow"))
 
     # Read configuration options from program-specific section.
     section = program[len("carbon-"):]
@@ -24,6 +24,8 @@ class Event:
 
 metricReceived = Event('metricReceived')
 metricGenerated = Event('metricGenerated')
+metricsReceived = Event('metricsReceived')
+metricsGenerated = Event('metricsGenerated')
 specialMetricReceived = Event('specialMetricReceived')
 specialMetricGenerated = Event('specialMetricGenerated')
 cacheFull = Event('cacheFull')
@@ -33,6 +35,8 @@ resumeReceivingMetrics = Event('resumeReceivingMetrics')
 
 # Default handlers
 metricReceived.addHandler(lambda metric, datapoint: state.instrumentation.increment('metricsReceived'))
+metricsReceived.addHandler(
+  lambda metrics: state.instrumentation.increment('metricsReceived', len(metrics)))
 specialMetricReceived.addHandler(lambda metric, datapoint: state.instrumentation.increment('metricsReceived'))
 
 
@@ -10,6 +10,12 @@ from carbon.conf import settings
 
 stats = {}
 prior_stats = {}
+worker_records = []  # Records of a receiver worker, sent to its parent
+worker_totals = {}  # Records of the receiver workers, summed by metric
+# Records of the current level of something rather than a count over the
+# interval, which the parent of receiver workers must not add up over time
+GAUGES = frozenset(['cpuUsage', 'memUsage', 'allocatedBuffers', 'bufferedDatapoints',
+                    'relayMaxQueueLength'])
 HOSTNAME = socket.gethostname().replace('.','_')
 PAGESIZE = os.sysconf('SC_PAGESIZE')
 rusage = getrusage(RUSAGE_SELF)
@@ -77,16 +83,24 @@ def recordMetrics():
   myPriorStats = {}
   stats.clear()
 
+  if state.receiver_supervisor is not None:
+    worker_totals.update(state.receiver_supervisor.takeRecords())
+
   # cache metrics
   if settings.program == 'carbon-cache':
     record = cache_record
     updateTimes = myStats.get('updateTimes', [])
+    createTimes = myStats.get('createTimes', [])
+    updateRates = myStats.get('updateRates', [])
+    syncTimes = myStats.get('syncTimes', [])
+    syncedFiles = myStats.get('syncedFiles', 0)
     committedPoints = myStats.get('committedPoints', 0)
     creates = myStats.get('creates', 0)
     droppedCreates = myStats.get('droppedCreates', 0)
     errors = myStats.get('errors', 0)
     cacheQueries = myStats.get('cacheQueries', 0)
     cacheBulkQueries = myStats.get('cacheBulkQueries', 0)
+    cacheFindQueries = myStats.get('cacheFindQueries', 0)
     cacheOverflow = myStats.get('cache.overflow', 0)
     cacheBulkQuerySizes = myStats.get('cacheBulkQuerySize', [])
 
@@ -94,6 +108,17 @@ def recordMetrics():
       avgUpdateTime = sum(updateTimes) / len(updateTimes)
       record('avgUpdateTime', avgUpdateTime)
 
+    if createTimes:
+      avgCreateTime = sum(createTimes) / len(createTimes)
+      record('avgCreateTime', avgCreateTime)
+
+    if updateRates:
+      record('updateRate', updateRates[-1])
+
+    if syncTimes:
+      avgSyncTime = sum(syncTimes) / len(syncTimes)
+      record('avgSyncTime', avgSyncTime)
+
     if committedPoints:
       pointsPerUpdate = float(committedPoints) / len(updateTimes)
       record('pointsPerUpdate', pointsPerUpdate)
@@ -106,12 +131,20 @@ def recordMetrics():
     record('committedPoints', committedPoints)
     record('creates', creates)
     record('droppedCreates', droppedCreates)
+    if settings.WHISPER_SYNC_INTERVAL:
+      record('syncedFiles', syncedFiles)
     record('errors', errors)
     record('cache.queries', cacheQueries)
     record('cache.bulk_queries', cacheBulkQueries)
+    record('cache.find_queries', cacheFindQueries)
     record('cache.queues', len(cache.MetricCache))
     record('cache.size', cache.MetricCache.size)
+    record('cache.bytes', cache.MetricCache.bytes)
     record('cache.overflow', cacheOverflow)
+    record('createBacklog.queues', len(cache.CreateBacklog))
+    record('createBacklog.size', cache.CreateBacklog.size)
+    if state.cache_overflow is not None:
+      record('cache.overflow_bytes', len(state.cache_overflow))
 
   # aggregator metrics
   elif settings.program == 'carbon-aggregator':
@@ -138,6 +171,7 @@ def recordMetrics():
   record('metricsReceived', myStats.get('metricsReceived', 0))
   record('blacklistMatches', myStats.get('blacklistMatches', 0))
   record('whitelistRejects', myStats.get('whitelistRejects', 0))
+  record('invalidLines', myStats.get('invalidLines', 0))
   record('cpuUsage', getCpuUsage())
 
   # And here preserve count of messages received in the prior periiod
@@ -150,6 +184,15 @@ def recordMetrics():
   except:
     pass
 
+  for fullMetric, value in worker_totals.items():  # recorded only by the receiver workers
+    generate(fullMetric, value)
+  worker_totals.clear()
+
+  if worker_records:
+    from carbon.workers import send_records
+    send_records(worker_records)
+    del worker_records[:]
+
 
 def cache_record(metric, value):
     prefix = settings.CARBON_METRIC_PREFIX
@@ -166,8 +209,7 @@ def relay_record(metric, value):
       fullMetric = '%s.relays.%s.%s' % (prefix, HOSTNAME, metric)
     else:
       fullMetric = '%s.relays.%s-%s.%s' % (prefix, HOSTNAME, settings.instance, metric)
-    datapoint = (time.time(), value)
-    events.metricGenerated(fullMetric, datapoint)
+    generate(fullMetric, value, metric.rsplit('.', 1)[-1] in GAUGES)
 
 def aggregator_record(metric, value):
     prefix = settings.CARBON_METRIC_PREFIX
@@ -175,6 +217,17 @@ def aggregator_record(metric, value):
       fullMetric = '%s.aggregator.%s.%s' % (prefix, HOSTNAME, metric)
     else:
       fullMetric = '%s.aggregator.%s-%s.%s' % (prefix, HOSTNAME, settings.instance, metric)
+    generate(fullMetric, value, metric.rsplit('.', 1)[-1] in GAUGES)
+
+
+def generate(fullMetric, value, is_gauge=False):
+    # Receiver worker processes leave their records to their parent, which
+    # adds them to its own
+    if settings.get('receiver_worker') is not None:
+      worker_records.append((fullMetric, value, is_gauge))
+      return
+    if state.receiver_supervisor is not None:
+      value += worker_totals.pop(fullMetric, 0)
     datapoint = (time.time(), value)
     events.metricGenerated(fullMetric, datapoint)
 
@@ -1,7 +1,5 @@
 import traceback
-import whisper
-from carbon import log
-from carbon.storage import getFilesystemPath
+from carbon import log, state
 
 
 
@@ -9,9 +7,8 @@ def getMetadata(metric, key):
   if key != 'aggregationMethod':
     return dict(error="Unsupported metadata key \"%s\"" % key)
 
-  wsp_path = getFilesystemPath(metric)
   try:
-    value = whisper.info(wsp_path)['aggregationMethod']
+    value = state.storage_backend.get_metadata(metric, key)
     return dict(value=value)
   except:
     log.err()
@@ -22,9 +19,8 @@ def setMetadata(metric, key, value):
   if key != 'aggregationMethod':
     return dict(error="Unsupported metadata key \"%s\"" % key)
 
-  wsp_path = getFilesystemPath(metric)
   try:
-    old_value = whisper.setAggregationMethod(wsp_path, value)
+    old_value = state.storage_backend.set_metadata(metric, key, value)
     return dict(old_value=old_value, new_value=value)
   except:
     log.err()
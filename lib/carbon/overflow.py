@@ -0,0 +1,125 @@
+"""Copyright 2009 Chris Davis
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+
+import os
+import threading
+from os.path import exists, join
+
+from twisted.application.service import Service
+from twisted.internet.task import LoopingCall
+
+from carbon.conf import settings
+from carbon.wal import RECORD
+from carbon import log
+
+
+MERGE_CHUNK_SIZE = 2 ** 20
+
+
+class CacheOverflow(object):
+  """An append-only file taking the datapoints that arrive while the cache is
+  full, up to MAX_CACHE_OVERFLOW_SIZE bytes. Records use the write-ahead log
+  format and are fed back into the cache, oldest first, whenever it has room.
+  The file is truncated each time it has been read to the end; anything left
+  over at shutdown is merged again after the next start."""
+  def __init__(self, directory, prefix):
+    if not exists(directory):
+      os.makedirs(directory)
+    self.path = join(directory, prefix + '.overflow')
+    self.lock = threading.Lock()
+    self.fh = open(self.path, 'ab')
+    self.size = self.fh.tell()
+    self.read_offset = 0
+    if self.size:
+      log.cache("%d bytes of overflowed datapoints pending in %s" % (self.size, self.path))
+
+  def __len__(self):
+    return self.size - self.read_offset
+
+  def write(self, metric, datapoint):
+    """Appends a datapoint, returning False if the overflow is itself full"""
+    timestamp, value = datapoint
+    record = RECORD.pack(len(metric), int(timestamp), value) + metric
+    with self.lock:
+      if self.size + len(record) > settings.MAX_CACHE_OVERFLOW_SIZE:
+        return False
+      self.fh.write(record)
+      self.size += len(record)
+    return True
+
+  def merge(self, cache):
+    """Moves overflowed datapoints back into cache until it is full again"""
+    with self.lock:
+      if self.read_offset >= self.size:
+        return 0
+      self.fh.flush()
+      end = self.size
+
+    merged = 0
+    fh = open(self.path, 'rb')
+    try:
+      while self.read_offset < end and not cache.is_full:
+        fh.seek(self.read_offset)
+        data = fh.read(min(MERGE_CHUNK_SIZE, end - self.read_offset))
+        offset = 0
+        while offset + RECORD.size <= len(data) and not cache.is_full:
+          name_length, timestamp, value = RECORD.unpack_from(data, offset)
+          if offset + RECORD.size + name_length > len(data):
+            break
+          metric = data[offset + RECORD.size:offset + RECORD.size + name_length]
+          cache.store(metric, (timestamp, value))
+          offset += RECORD.size + name_length
+          merged += 1
+        if not offset:
+          break
+        self.read_offset += offset
+    finally:
+      fh.close()
+
+    with self.lock:
+      if self.read_offset >= self.size:
+        self.fh.truncate(0)
+        self.fh.seek(0)
+        self.size = self.read_offset = 0
+    return merged
+
+  def close(self):
+    with self.lock:
+      self.fh.close()
+      if self.read_offset >= self.size:
+        os.unlink(self.path)
+
+
+class CacheOverflowService(Service):
+  def __init__(self, overflow, cache):
+    self.overflow = overflow
+    self.cache = cache
+    self.merge_task = LoopingCall(self.merge)
+
+  def merge(self):
+    if not state.cacheTooFull:
+      self.overflow.merge(self.cache)
+
+  def startService(self):
+    self.merge_task.start(settings.CACHE_OVERFLOW_MERGE_INTERVAL, False)
+    Service.startService(self)
+
+  def stopService(self):
+    self.merge_task.stop()
+    self.overflow.close()
+    Service.stopService(self)
+
+
+# Avoid import circularities
+from carbon import state
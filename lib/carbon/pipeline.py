@@ -13,6 +13,18 @@ class Processor(object):
   def process(self, metric, datapoint):
     raise NotImplemented()
 
+  def process_batch(self, metrics):
+    """Processes a list of (metric, datapoint) pairs, returning a list of the
+    pairs to pass on. Override this if the processor can do better than
+    handling one datapoint at a time."""
+    output = []
+    for metric, datapoint in metrics:
+      try:
+        output.extend(self.process(metric, datapoint))
+      except:
+        log.err()
+    return output
+
 
 def run_pipeline(metric, datapoint, processors=None):
   if processors is None:
@@ -29,3 +41,19 @@ def run_pipeline(metric, datapoint, processors=None):
         log.err()
   except:
     log.err()
+
+
+def run_pipeline_batch(metrics, processors=None):
+  """Like run_pipeline() for a list of (metric, datapoint) pairs, which each
+  processor handles in one process_batch() call"""
+  if processors is None:
+    processors = state.pipeline_processors
+
+  for processor in processors:
+    if not metrics:
+      return
+    try:
+      metrics = processor.process_batch(metrics)
+    except:
+      log.err()
+      return
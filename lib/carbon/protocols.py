@@ -1,4 +1,5 @@
 import time
+from math import isinf, isnan
 
 from twisted.internet import reactor
 from twisted.internet.protocol import DatagramProtocol
@@ -7,7 +8,7 @@ from twisted.protocols.basic import LineOnlyReceiver, Int32StringReceiver
 from carbon import log, events, state, management
 from carbon.conf import settings
 from carbon.regexlist import WhiteList, BlackList
-from carbon.util import pickle, get_unpickler
+from carbon.util import pickle, get_unpickler, intern_name, decode_binary
 
 
 class MetricReceiver:
@@ -54,44 +55,88 @@ class MetricReceiver:
       events.resumeReceivingMetrics.removeHandler(self.resumeReceiving)
 
   def metricReceived(self, metric, datapoint):
-    if BlackList and metric in BlackList:
-      instrumentation.increment('blacklistMatches')
-      return
-    if WhiteList and metric not in WhiteList:
-      instrumentation.increment('whitelistRejects')
-      return
-    if datapoint[1] != datapoint[1]: # filter out NaN values
-      return
-    if int(datapoint[0]) == -1: # use current time if none given: https://github.com/graphite-project/carbon/issues/54
-      datapoint = (time.time(), datapoint[1])
-    
-    events.metricReceived(metric, datapoint)
+    self.metricsReceived(((metric, datapoint),))
+
+  def metricsReceived(self, metrics):
+    """Filters a sequence of (metric, datapoint) pairs and passes on the rest
+    as one batch"""
+    # The lists are only reloaded by the reactor, so they cannot change
+    # during the loop
+    checkBlackList = bool(BlackList)
+    checkWhiteList = bool(WhiteList)
+    batch = []
+    append = batch.append
+    for (metric, datapoint) in metrics:
+      if checkBlackList and metric in BlackList:
+        instrumentation.increment('blacklistMatches')
+        continue
+      if checkWhiteList and metric not in WhiteList:
+        instrumentation.increment('whitelistRejects')
+        continue
+      if datapoint[1] != datapoint[1]:  # filter out NaN values
+        continue
+      try:
+        # use current time if none given: https://github.com/graphite-project/carbon/issues/54
+        if int(datapoint[0]) == -1:
+          datapoint = (time.time(), datapoint[1])
+      except (ValueError, OverflowError):
+        continue  # NaN or infinite timestamps
+
+      append((intern_name(metric), datapoint))
+
+    if batch:
+      events.metricsReceived(batch)
+
+  def parseLines(self, lines, source):
+    """Returns the (metric, datapoint) pairs of lines in the plaintext protocol.
+    Invalid lines are logged and counted as invalidLines."""
+    metrics = []
+    append = metrics.append
+    invalid = 0
+    for line in lines:
+      try:
+        metric, value, timestamp = line.split()
+        timestamp = float(timestamp)
+        if isnan(timestamp) or isinf(timestamp):
+          raise ValueError(timestamp)
+        append((metric, (timestamp, float(value))))
+      except ValueError:
+        invalid += 1
+        log.listener('invalid line (%s) received from %s, ignoring' % (line.strip(), source))
+    if invalid:
+      instrumentation.increment('invalidLines', invalid)
+    return metrics
 
 
 class MetricLineReceiver(MetricReceiver, LineOnlyReceiver):
   delimiter = '\n'
 
-  def lineReceived(self, line):
-    try:
-      metric, value, timestamp = line.strip().split()
-      datapoint = (float(timestamp), float(value))
-    except ValueError:
-      log.listener('invalid line (%s) received from client %s, ignoring' % (line.strip(), self.peerName))
+  def dataReceived(self, data):
+    """Parses all the complete lines received at once, keeping any partial
+    line at the end for the next call"""
+    lines = (self._buffer + data).split(self.delimiter)
+    self._buffer = lines.pop()
+    if self.transport.disconnecting:
       return
-
-    self.metricReceived(metric, datapoint)
+    # Like LineOnlyReceiver, pass on the lines before any that is too long,
+    # then drop the connection
+    tooLong = None
+    for i, line in enumerate(lines):
+      if len(line) > self.MAX_LENGTH:
+        tooLong = line
+        del lines[i:]
+        break
+    if lines:
+      self.metricsReceived(self.parseLines(lines, 'client %s' % self.peerName))
+    if tooLong is not None:
+      return self.lineLengthExceeded(tooLong)
+    if len(self._buffer) > self.MAX_LENGTH:
+      return self.lineLengthExceeded(self._buffer)
 
 
 class MetricDatagramReceiver(MetricReceiver, DatagramProtocol):
   def datagramReceived(self, data, (host, port)):
-    for line in data.splitlines():
-      try:
-        metric, value, timestamp = line.strip().split()
-        datapoint = ( float(timestamp), float(value) )
-
-        self.metricReceived(metric, datapoint)
-      except ValueError:
-        log.listener('invalid line (%s) received from %s, ignoring' % (line, host))
+    self.metricsReceived(self.parseLines(data.splitlines(), host))
 
 
 class MetricPickleReceiver(MetricReceiver, Int32StringReceiver):
@@ -108,13 +153,33 @@ class MetricPickleReceiver(MetricReceiver, Int32StringReceiver):
       log.listener('invalid pickle received from %s, ignoring' % self.peerName)
       return
 
+    metrics = []
+    append = metrics.append
     for (metric, datapoint) in datapoints:
       try:
-        datapoint = ( float(datapoint[0]), float(datapoint[1]) ) #force proper types
+        timestamp = float(datapoint[0])  # force proper types
+        if isnan(timestamp) or isinf(timestamp):
+          continue
+        append((metric, (timestamp, float(datapoint[1]))))
       except ValueError:
         continue
 
-      self.metricReceived(metric, datapoint)
+    self.metricsReceived(metrics)
+
+
+class MetricBinaryReceiver(MetricReceiver, Int32StringReceiver):
+  """Receives messages in the binary protocol, a compact alternative to the
+  pickle protocol that is cheap to parse and safe to accept from anyone"""
+  MAX_LENGTH = 2 ** 20
+
+  def stringReceived(self, data):
+    try:
+      metrics = decode_binary(data)
+    except ValueError, e:
+      log.listener('invalid binary message received from %s, ignoring: %s' % (self.peerName, e))
+      return
+
+    self.metricsReceived(metrics)
 
 
 class CacheManagementHandler(Int32StringReceiver):
@@ -136,7 +201,7 @@ class CacheManagementHandler(Int32StringReceiver):
     request = self.unpickler.loads(rawRequest)
     if request['type'] == 'cache-query':
       metric = request['metric']
-      datapoints = MetricCache.get(metric, [])
+      datapoints = MetricCache.get_datapoints(metric)
       result = dict(datapoints=datapoints)
       if settings.LOG_CACHE_HITS:
         log.query('[%s] cache query for \"%s\" returned %d values' % (self.peerAddr, metric, len(datapoints)))
@@ -146,7 +211,7 @@ class CacheManagementHandler(Int32StringReceiver):
       datapointsByMetric = {}
       metrics = request['metrics']
       for metric in metrics:
-        datapointsByMetric[metric] = MetricCache.get(metric, [])
+        datapointsByMetric[metric] = MetricCache.get_datapoints(metric)
 
       result = dict(datapointsByMetric=datapointsByMetric)
 
@@ -156,6 +221,17 @@ class CacheManagementHandler(Int32StringReceiver):
       instrumentation.increment('cacheBulkQueries')
       instrumentation.append('cacheBulkQuerySize', len(metrics))
 
+    elif request['type'] == 'cache-find':
+      if state.cache_names is None:
+        result = dict(error="cache-find requires ENABLE_CACHE_FIND")
+      else:
+        nodes = state.cache_names.find(request['pattern'])
+        result = dict(nodes=nodes)
+        if settings.LOG_CACHE_HITS:
+          log.query('[%s] cache find for \"%s\" returned %d nodes' %
+                    (self.peerAddr, request['pattern'], len(nodes)))
+        instrumentation.increment('cacheFindQueries')
+
     elif request['type'] == 'get-metadata':
       result = management.getMetadata(request['metric'], request['key'])
 
@@ -3,6 +3,7 @@ from collections import defaultdict
 from os.path import exists, getmtime
 from twisted.internet.task import LoopingCall
 from carbon.pipeline import Processor
+from carbon.util import intern_name
 from carbon import log
 
 # rulesets
@@ -19,7 +20,18 @@ class RewriteProcessor(Processor):
   def process(self, metric, datapoint):
     for rule in RewriteRuleManager.rules(self.ruleset):
       metric = rule.apply(metric)
-    yield (metric, datapoint)
+    yield (intern_name(metric), datapoint)
+
+  def process_batch(self, metrics):
+    rules = RewriteRuleManager.rules(self.ruleset)
+    if not rules:
+      return metrics
+    output = []
+    for metric, datapoint in metrics:
+      for rule in rules:
+        metric = rule.apply(metric)
+      output.append((intern_name(metric), datapoint))
+    return output
 
 
 class RewriteRuleManager:
@@ -12,6 +12,8 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
 
+import os
+import sys
 from os.path import exists
 
 from twisted.application.service import MultiService
@@ -23,7 +25,7 @@ from twisted.python.log import ILogObserver
 from carbon import state, events, instrumentation, util
 from carbon.exceptions import CarbonConfigException
 from carbon.log import carbonLogObserver
-from carbon.pipeline import Processor, run_pipeline
+from carbon.pipeline import Processor, run_pipeline, run_pipeline_batch
 state.events = events
 state.instrumentation = instrumentation
 
@@ -41,7 +43,15 @@ def createBaseService(config, settings):
     root_service = CarbonRootService()
     root_service.setName(settings.program)
 
-    setupReceivers(root_service, settings)
+    if settings.RECEIVER_PROCESSES > 1 and settings.program != 'carbon-cache':
+      setupReceiverWorkers(root_service, settings)
+    else:
+      setupReceivers(root_service, settings)
+
+    # Receiver workers only run the receivers that share their ports
+    if settings.get('receiver_worker') is None:
+      setupAMQPListener(root_service, settings)
+      setupManhole(root_service, settings)
 
     if settings.USE_WHITELIST:
       from carbon.regexlist import WhiteList, BlackList
@@ -82,6 +92,8 @@ def setupPipeline(pipeline, root_service, settings):
 
   events.metricReceived.addHandler(run_pipeline)
   events.metricGenerated.addHandler(run_pipeline)
+  events.metricsReceived.addHandler(run_pipeline_batch)
+  events.metricsGenerated.addHandler(run_pipeline_batch)
 
   #XXX This effectively reverts the desired behavior in b1a2aecb as I dont see a clear route to
   # port to pipelines. Perhaps a use case for passing a metric metadata dict along the pipeline?
@@ -123,25 +135,56 @@ def createRelayService(config):
   return root_service
 
 
-def setupReceivers(root_service, settings):
-  from carbon.protocols import MetricLineReceiver, MetricPickleReceiver, MetricDatagramReceiver
+def setupReceiverWorkers(root_service, settings):
+  """With RECEIVER_PROCESSES, a carbon-relay or carbon-aggregator runs that
+  many copies of itself as worker processes, which share its receiver ports
+  through SO_REUSEPORT, and supervises them. Only the AMQP listener and the
+  manhole, which cannot be shared, are left to it."""
+  from carbon import workers
+  workers.check_reuse_port()
+
+  if settings.get('receiver_worker') is None:
+    argv = [os.path.abspath(sys.argv[0])] + sys.argv[1:]
+    supervisor = workers.ReceiverSupervisorService(int(settings.RECEIVER_PROCESSES), argv)
+    supervisor.setServiceParent(root_service)
+  else:
+    setupReceivers(root_service, settings, reuse_port=True)
+    workers.ReceiverWorkerService().setServiceParent(root_service)
+
+
+def setupReceivers(root_service, settings, reuse_port=False):
+  from carbon.protocols import MetricLineReceiver, MetricPickleReceiver, MetricDatagramReceiver, \
+      MetricBinaryReceiver
 
   for protocol, interface, port in [
       (MetricLineReceiver, settings.LINE_RECEIVER_INTERFACE, settings.LINE_RECEIVER_PORT),
-      (MetricPickleReceiver, settings.PICKLE_RECEIVER_INTERFACE, settings.PICKLE_RECEIVER_PORT)
+      (MetricPickleReceiver, settings.PICKLE_RECEIVER_INTERFACE, settings.PICKLE_RECEIVER_PORT),
+      (MetricBinaryReceiver, settings.BINARY_RECEIVER_INTERFACE, settings.BINARY_RECEIVER_PORT)
     ]:
     if port:
       factory = ServerFactory()
       factory.protocol = protocol
-      service = TCPServer(port, factory, interface=interface)
+      if reuse_port:
+        from carbon.workers import ReusePortServer, ReusePortTCPPort
+        service = ReusePortServer(ReusePortTCPPort, port, factory, interface=interface)
+      else:
+        service = TCPServer(port, factory, interface=interface)
       service.setServiceParent(root_service)
 
   if settings.ENABLE_UDP_LISTENER:
-      service = UDPServer(int(settings.UDP_RECEIVER_PORT),
-                          MetricDatagramReceiver(),
-                          interface=settings.UDP_RECEIVER_INTERFACE)
+      if reuse_port:
+        from carbon.workers import ReusePortServer, ReusePortUDPPort
+        service = ReusePortServer(ReusePortUDPPort, int(settings.UDP_RECEIVER_PORT),
+                                  MetricDatagramReceiver(),
+                                  interface=settings.UDP_RECEIVER_INTERFACE)
+      else:
+        service = UDPServer(int(settings.UDP_RECEIVER_PORT),
+                            MetricDatagramReceiver(),
+                            interface=settings.UDP_RECEIVER_INTERFACE)
       service.setServiceParent(root_service)
 
+
+def setupAMQPListener(root_service, settings):
   if settings.ENABLE_AMQP:
     from carbon import amqp_listener
     amqp_host = settings.AMQP_HOST
@@ -163,6 +206,8 @@ def setupReceivers(root_service, settings):
     service = TCPClient(amqp_host, amqp_port, factory)
     service.setServiceParent(root_service)
 
+
+def setupManhole(root_service, settings):
   if settings.ENABLE_MANHOLE:
     from carbon import manhole
 
@@ -196,6 +241,9 @@ def setupRelayProcessor(root_service, settings):
       ConsistentHashingRouter, RelayRulesRouter
   from carbon.client import CarbonClientManager
 
+  if settings.DESTINATION_PROTOCOL not in ('pickle', 'binary'):
+    raise ValueError("Invalid destination protocol '%s'" % settings.DESTINATION_PROTOCOL)
+
   if settings.RELAY_METHOD == 'consistent-hashing':
     router = ConsistentHashingRouter(settings.REPLICATION_FACTOR)
   elif settings.RELAY_METHOD == 'aggregated-consistent-hashing':
@@ -215,6 +263,39 @@ def setupRelayProcessor(root_service, settings):
 
 def setupWriterProcessor(root_service, settings):
   from carbon import cache  # Register CacheFeedingProcessor
+  cache.MetricCache.configure()
+
+  if settings.instance:
+    prefix = '%s-%s' % (settings.program, settings.instance)
+  else:
+    prefix = settings.program
+
+  from carbon.backends import StorageBackend
+  if settings.STORAGE_BACKEND not in StorageBackend.plugins:
+    raise ValueError("Invalid storage backend '%s'" % settings.STORAGE_BACKEND)
+  state.storage_backend = StorageBackend.plugins[settings.STORAGE_BACKEND]()
+
+  if settings.ENABLE_CACHE_WAL:
+    from carbon.wal import WriteAheadLog, WriteAheadLogService
+    state.cache_wal = WriteAheadLog(settings.CACHE_WAL_DIR, prefix)
+    for shard in cache.MetricCache.shards:
+      shard.watch(state.cache_wal)
+    cache.CreateBacklog.watch(state.cache_wal)
+    wal_service = WriteAheadLogService(state.cache_wal, cache.MetricCache, cache.CreateBacklog)
+    wal_service.setServiceParent(root_service)
+
+  if settings.ENABLE_CACHE_FIND:
+    from carbon.trie import MetricTrie
+    state.cache_names = MetricTrie()
+    for shard in cache.MetricCache.shards:
+      shard.watch(state.cache_names)
+
+  if settings.ENABLE_CACHE_OVERFLOW:
+    from carbon.overflow import CacheOverflow, CacheOverflowService
+    state.cache_overflow = CacheOverflow(settings.CACHE_OVERFLOW_DIR, prefix)
+    overflow_service = CacheOverflowService(state.cache_overflow, cache.MetricCache)
+    overflow_service.setServiceParent(root_service)
+
   from carbon.protocols import CacheManagementHandler
   from carbon.writer import WriterService
   from carbon import events
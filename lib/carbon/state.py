@@ -6,5 +6,10 @@ several modules.
 metricReceiversPaused = False
 cacheTooFull = False
 client_manager = None
+cache_wal = None
+cache_overflow = None
+cache_names = None
+storage_backend = None
+receiver_supervisor = None
 connectedMetricReceiverProtocols = set()
 pipeline_processors = []
@@ -13,15 +13,23 @@ See the License for the specific language governing permissions and
 limitations under the License."""
 
 import os, re
+import time
+import resource
+import threading
 import whisper
+from collections import OrderedDict
+from errno import EEXIST
 
 from os.path import join, exists, sep
 from carbon.conf import OrderedConfigParser, settings
 from carbon.exceptions import CarbonConfigException
-from carbon.util import pickle
+from carbon.util import pickle, intern_name
 from carbon import log
 
 
+# fdatasync() skips flushing metadata such as access times, where available
+fdatasync = getattr(os, 'fdatasync', os.fsync)
+
 STORAGE_SCHEMAS_CONFIG = join(settings.CONF_DIR, 'storage-schemas.conf')
 STORAGE_AGGREGATION_CONFIG = join(settings.CONF_DIR, 'storage-aggregation.conf')
 STORAGE_LISTS_DIR = join(settings.CONF_DIR, 'lists')
@@ -31,6 +39,208 @@ def getFilesystemPath(metric):
   return join(settings.LOCAL_DATA_DIR, metric_path)
 
 
+class KnownFiles(object):
+  """The metrics whose database files are known to exist, so that the writer
+  only has to stat() a file the first time it sees the metric. Entries are
+  added by scan() or on a successful stat, and removed by discard() when a
+  write finds the file gone."""
+  def __init__(self):
+    self.metrics = set()
+
+  def __len__(self):
+    return len(self.metrics)
+
+  def exists(self, metric, path):
+    if metric in self.metrics:
+      return True
+    if exists(path):
+      self.metrics.add(metric)
+      return True
+    return False
+
+  def add(self, metric):
+    self.metrics.add(metric)
+
+  def discard(self, metric):
+    self.metrics.discard(metric)
+
+  def scan(self, directory):
+    """Adds every database file found under directory"""
+    start = time.time()
+    count = 0
+    for root, dirs, files in os.walk(directory):
+      prefix = os.path.relpath(root, directory)
+      if prefix == os.curdir:
+        prefix = ''
+      else:
+        prefix = prefix.replace(sep, '.') + '.'
+      for filename in files:
+        if filename.endswith('.wsp'):
+          self.metrics.add(intern_name(prefix + filename[:-4]))
+          count += 1
+    log.msg("found %d database files in %s in %.2f seconds" %
+            (count, directory, time.time() - start))
+
+
+class KnownDirectories(object):
+  """A bounded LRU of the directories known to exist, so that creating many
+  database files in one directory checks for it, and makes it if need be, only
+  once. Directories removed from disk are noticed when a create fails and its
+  directory is discarded."""
+  def __init__(self, capacity):
+    self.lock = threading.Lock()
+    self.directories = OrderedDict()
+    self.capacity = capacity
+
+  def __len__(self):
+    return len(self.directories)
+
+  def ensure(self, directory):
+    """Makes directory unless it is known to exist"""
+    with self.lock:
+      if self.directories.pop(directory, False):
+        self.directories[directory] = True
+        return
+    try:
+      os.makedirs(directory)
+    except OSError, e:
+      if e.errno != EEXIST:
+        raise
+    with self.lock:
+      self.directories[directory] = True
+      while len(self.directories) > self.capacity:
+        self.directories.popitem(last=False)
+
+  def discard(self, directory):
+    with self.lock:
+      self.directories.pop(directory, None)
+
+
+def _is_open_on(fh, path):
+  """Whether fh is open on the file now at path, rather than on one since
+  removed or replaced"""
+  try:
+    st = os.stat(path)
+  except OSError:
+    return False
+  fst = os.fstat(fh.fileno())
+  return (st.st_ino, st.st_dev) == (fst.st_ino, fst.st_dev)
+
+
+class _OpenFiles(object):
+  """An LRU of database files kept open between updates, so that frequently
+  written metrics skip reopening the file and, with whisper's header cache,
+  reparsing its header. A handle is checked out for the duration of an update,
+  so no two threads ever share one. A handle is reopened when the file at its
+  path has been removed or replaced, and after OPEN_DATABASE_FILE_MAX_AGE
+  seconds regardless."""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.handles = OrderedDict()  # { path : (file, time opened) }
+    self.capacity = None
+
+  def __len__(self):
+    return len(self.handles)
+
+  def _capacity(self):
+    if self.capacity is None:
+      capacity = settings.MAX_OPEN_DATABASE_FILES
+      # Leave at least half of the descriptors for sockets and everything else
+      soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+      if soft_limit != resource.RLIM_INFINITY:
+        capacity = min(capacity, soft_limit // 2)
+      self.capacity = max(0, int(capacity))
+    return self.capacity
+
+  def checkout(self, path):
+    """Returns an open handle on path, as a (file, time opened) pair to be given
+    back to checkin() or close() when done"""
+    with self.lock:
+      entry = self.handles.pop(path, None)
+    if entry is not None:
+      if (time.time() - entry[1] < settings.OPEN_DATABASE_FILE_MAX_AGE and
+          _is_open_on(entry[0], path)):
+        return entry
+      self.close(path, entry)
+
+    # Raises ENOENT if the file has been removed
+    fh = open(path, 'r+b', getattr(whisper, 'BUFFERING', 0))
+    if getattr(whisper, 'CAN_FADVISE', False) and whisper.FADVISE_RANDOM:
+      whisper.posix_fadvise(fh.fileno(), 0, 0, whisper.POSIX_FADV_RANDOM)
+    return (fh, time.time())
+
+  def checkin(self, path, entry):
+    evicted = []
+    with self.lock:
+      self.handles[path] = entry
+      while len(self.handles) > self._capacity():
+        evicted.append(self.handles.popitem(last=False))
+    for path, entry in evicted:
+      self.close(path, entry)
+
+  def close(self, path, entry):
+    entry[0].close()
+    getattr(whisper, '__headerCache', {}).pop(path, None)
+
+  def invalidate(self, path):
+    """Closes any handle on path, e.g. after the file was changed elsewhere"""
+    with self.lock:
+      entry = self.handles.pop(path, None)
+    if entry is not None:
+      self.close(path, entry)
+
+  def close_all(self):
+    with self.lock:
+      handles, self.handles = self.handles, OrderedDict()
+    for path, entry in handles.iteritems():
+      self.close(path, entry)
+
+
+class DirtyFiles(object):
+  """Database files written since they were last synced to disk. Rather than
+  have whisper fsync() each file on every update, as WHISPER_AUTOFLUSH does,
+  the files are synced together every WHISPER_SYNC_INTERVAL seconds or once
+  WHISPER_SYNC_MAX_DIRTY_FILES of them are waiting, which bounds the window of
+  updates lost on a crash at a fraction of the cost."""
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.paths = set()
+    self.last_sync = time.time()
+    self.ready = threading.Event()  # Set once enough files are dirty
+
+  def __len__(self):
+    return len(self.paths)
+
+  def add(self, path):
+    """Marks path dirty, returning whether a sync is due"""
+    with self.lock:
+      self.paths.add(path)
+      count = len(self.paths)
+    if count >= settings.WHISPER_SYNC_MAX_DIRTY_FILES:
+      self.ready.set()
+      return True
+    return time.time() - self.last_sync >= settings.WHISPER_SYNC_INTERVAL
+
+  def sync(self):
+    """Flushes the data of every dirty file to disk, returning their number"""
+    with self.lock:
+      paths, self.paths = self.paths, set()
+      self.last_sync = time.time()
+      self.ready.clear()
+    for path in paths:
+      try:
+        fd = os.open(path, os.O_RDONLY)
+      except OSError:
+        continue  # Removed since it was written
+      try:
+        fdatasync(fd)
+      except OSError, e:
+        log.err("Failed to sync %s: %s" % (path, e))
+      finally:
+        os.close(fd)
+    return len(paths)
+
+
 class Schema:
   def test(self, metric):
     raise NotImplementedError()
@@ -110,6 +320,111 @@ class Archive:
     return Archive(secondsPerPoint, points)
 
 
+# Python 2's re module supports at most 100 capturing groups per pattern
+MAX_COMBINED_GROUPS = 99
+UNCOMBINABLE = re.compile(r'\\[1-9]|\(\?P=|\(\?\(')
+
+
+def _combinable(schema):
+  """Whether a pattern can be embedded in a larger alternation without
+  changing its meaning: inline flags would apply to the whole alternation, and
+  group names and back references would clash or be renumbered"""
+  regex = schema.regex
+  return not (regex.flags or regex.groupindex or UNCOMBINABLE.search(schema.pattern))
+
+
+def _definition(schema):
+  if isinstance(schema, PatternSchema):
+    key = schema.pattern
+  elif isinstance(schema, ListSchema):
+    key = schema.listName
+  else:
+    key = None
+  if isinstance(schema.archives, list):
+    archives = tuple(archive.getTuple() for archive in schema.archives)
+  else:
+    archives = schema.archives
+  return (schema.__class__.__name__, schema.name, key, archives)
+
+
+class SchemaMatcher(object):
+  """Resolves metrics to the first matching schema of a list. Runs of
+  consecutive pattern schemas are tried in one pass of a combined regex, and
+  results are memoized in an LRU of cache_size metrics. Results that depend on
+  a list schema are not memoized, as the list may change at any time."""
+  def __init__(self, schemas, cache_size=100000):
+    self.schemas = schemas
+    self.definition = [_definition(schema) for schema in schemas]
+    self.cache_size = cache_size
+    self.cache = OrderedDict()
+    self.lock = threading.Lock()
+    self.steps = []  # (combined regex, None) or (None, schema index)
+
+    run = []
+    run_groups = 0
+    for index, schema in enumerate(schemas):
+      if isinstance(schema, PatternSchema) and _combinable(schema):
+        groups = schema.regex.groups + 1
+        if run and run_groups + groups > MAX_COMBINED_GROUPS:
+          self._add_run(run)
+          run, run_groups = [], 0
+        run.append(index)
+        run_groups += groups
+      else:
+        if run:
+          self._add_run(run)
+          run, run_groups = [], 0
+        self.steps.append((None, index))
+    if run:
+      self._add_run(run)
+
+  def _add_run(self, indexes):
+    if len(indexes) == 1:
+      self.steps.append((None, indexes[0]))
+      return
+    # Anchoring makes the alternatives be tried in order, each at every
+    # position, which gives the same result as searching with each in turn
+    alternatives = [r'(?P<s%d>[\s\S]*?(?:%s))' % (index, self.schemas[index].pattern)
+                    for index in indexes]
+    self.steps.append((re.compile('^(?:%s)' % '|'.join(alternatives)), None))
+
+  def __eq__(self, other):
+    return isinstance(other, SchemaMatcher) and self.definition == other.definition
+
+  def __ne__(self, other):
+    return not self == other
+
+  def match(self, metric):
+    with self.lock:
+      schema = self.cache.pop(metric, None)
+      if schema is not None:
+        self.cache[metric] = schema
+        return schema
+
+    cacheable = True
+    schema = None
+    for regex, index in self.steps:
+      if regex is not None:
+        match = regex.match(metric)
+        if match:
+          schema = self.schemas[int(match.lastgroup[1:])]
+          break
+      else:
+        candidate = self.schemas[index]
+        if isinstance(candidate, ListSchema):
+          cacheable = False
+        if candidate.matches(metric):
+          schema = candidate
+          break
+
+    if schema is not None and cacheable and self.cache_size:
+      with self.lock:
+        self.cache[metric] = schema
+        if len(self.cache) > self.cache_size:
+          self.cache.popitem(last=False)
+    return schema
+
+
 def loadStorageSchemas():
   schemaList = []
   config = OrderedConfigParser()
@@ -190,6 +505,9 @@ def loadAggregationSchemas():
   schemaList.append(defaultAggregation)
   return schemaList
 
+
+OpenFiles = _OpenFiles()
+
 defaultArchive = Archive(60, 60 * 24 * 7) #default retention for unclassified data (7 days of minutely data)
 defaultSchema = DefaultSchema('default', [defaultArchive])
 defaultAggregation = DefaultSchema('default', (None, None))
@@ -41,3 +41,8 @@ class AggregationRuleTest(unittest.TestCase):
                          None)
         self.assertEqual(rule999.get_aggregate_metric('hosts.abc.hist.p999'),
                          'aggregated.hist.p999')
+
+    def test_aggregate_metric_is_interned(self):
+        rule = AggregationRule('hosts.<host>.cpu', 'aggregated.<host>.cpu', 'sum', 10)
+        metric = rule.get_aggregate_metric('hosts.abc.cpu')
+        self.assertTrue(metric is intern('aggregated.abc.cpu'))
@@ -0,0 +1,123 @@
+import os
+import shutil
+import tempfile
+import time
+from errno import ENOENT
+from unittest import TestCase
+from mock import patch
+
+import whisper
+
+# carbon.storage locates its config files at import
+with patch.dict('carbon.conf.settings', {'CONF_DIR': '/nonexistent'}):
+  from carbon.backends import MemoryBackend, NullBackend, StorageBackend, WhisperBackend
+
+
+class StorageBackendTest(TestCase):
+  def test_plugins_are_registered(self):
+    self.assertEqual(WhisperBackend, StorageBackend.plugins['whisper'])
+    self.assertEqual(NullBackend, StorageBackend.plugins['null'])
+    self.assertEqual(MemoryBackend, StorageBackend.plugins['memory'])
+
+
+class NullBackendTest(TestCase):
+  def setUp(self):
+    self.backend = NullBackend()
+
+  def test_create(self):
+    self.assertFalse(self.backend.exists('foo'))
+    self.backend.create('foo', [(60, 1440)])
+    self.assertTrue(self.backend.exists('foo'))
+
+  def test_update_missing_metric(self):
+    try:
+      self.backend.update_many('foo', [(123456, 1.0)])
+    except IOError, e:
+      self.assertEqual(ENOENT, e.errno)
+    else:
+      self.fail("IOError not raised")
+
+
+class MemoryBackendTest(TestCase):
+  def setUp(self):
+    self.backend = MemoryBackend()
+    self.backend.create('foo', [(60, 10), (600, 6)], 0.5, 'max')
+
+  def test_update_quantizes_to_finest_step(self):
+    self.backend.update_many('foo', [(120, 1.0), (185, 2.0), (190, 3.0)])
+    self.assertEqual([(120, 1.0), (180, 3.0)], self.backend.fetch('foo'))
+
+  def test_expires_old_points(self):
+    self.backend.update_many('foo', [(t * 60, float(t)) for t in range(100)])
+    points = self.backend.fetch('foo')
+    self.assertEqual(99 * 60, points[-1][0])
+    self.assertTrue(points[0][0] >= 99 * 60 - 3600)
+
+  def test_update_missing_metric(self):
+    self.assertRaises(IOError, self.backend.update_many, 'bar', [(120, 1.0)])
+
+  def test_metadata(self):
+    self.assertEqual('max', self.backend.get_metadata('foo', 'aggregationMethod'))
+    self.assertEqual('max', self.backend.set_metadata('foo', 'aggregationMethod', 'sum'))
+    self.assertEqual('sum', self.backend.get_metadata('foo', 'aggregationMethod'))
+
+
+class WhisperBackendTest(TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    settings = {
+      'LOCAL_DATA_DIR': self.directory,
+      'MAX_OPEN_DATABASE_FILES': 0,
+      'WHISPER_SPARSE_CREATE': False,
+      'WHISPER_FALLOCATE_CREATE': False,
+    }
+    self._settings_patch = patch.dict('carbon.conf.settings', settings)
+    self._settings_patch.start()
+    self.backend = WhisperBackend()
+
+  def tearDown(self):
+    self._settings_patch.stop()
+    shutil.rmtree(self.directory)
+
+  def test_create_and_update(self):
+    self.assertFalse(self.backend.exists('foo.bar'))
+    self.backend.create('foo.bar', [(60, 1440)], 0.5, 'sum')
+    self.assertTrue(self.backend.exists('foo.bar'))
+    self.assertTrue(os.path.isfile(os.path.join(self.directory, 'foo', 'bar.wsp')))
+    self.assertEqual('sum', self.backend.get_metadata('foo.bar', 'aggregationMethod'))
+
+    timestamp = int(time.time()) // 60 * 60
+    self.backend.update_many('foo.bar', [(timestamp, 1.0)])
+    path = os.path.join(self.directory, 'foo', 'bar.wsp')
+    (_timeInfo, values) = whisper.fetch(path, timestamp - 60, timestamp + 60)
+    self.assertTrue(1.0 in values)
+
+  def test_create_in_removed_directory(self):
+    self.backend.create('foo.bar', [(60, 1440)])
+    shutil.rmtree(os.path.join(self.directory, 'foo'))
+    self.backend.create('foo.baz', [(60, 1440)])
+    self.assertTrue(os.path.isfile(os.path.join(self.directory, 'foo', 'baz.wsp')))
+
+  def test_update_removed_file(self):
+    self.backend.create('foo', [(60, 1440)])
+    os.unlink(os.path.join(self.directory, 'foo.wsp'))
+    self.assertRaises(IOError, self.backend.update_many, 'foo', [(123456, 1.0)])
+    self.assertFalse(self.backend.exists('foo'))
+
+  def test_sync_after_max_dirty_files(self):
+    self._settings_patch.values.update({
+      'WHISPER_SYNC_INTERVAL': 60,
+      'WHISPER_SYNC_MAX_DIRTY_FILES': 2,
+      'WHISPER_SYNC_THREAD': False,
+    })
+    self._settings_patch.start()
+    backend = WhisperBackend()
+    timestamp = int(time.time())
+    for metric in ('foo', 'bar'):
+      backend.create(metric, [(60, 1440)])
+    with patch('carbon.storage.fdatasync') as fdatasync:
+      backend.update_many('foo', [(timestamp, 1.0)])
+      self.assertEqual(0, fdatasync.call_count)
+      backend.update_many('bar', [(timestamp, 1.0)])
+      self.assertEqual(2, fdatasync.call_count)
+    self.assertEqual(0, len(backend.dirty_files))
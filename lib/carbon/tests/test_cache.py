@@ -1,6 +1,7 @@
 from unittest import TestCase
 from mock import Mock, PropertyMock, patch
-from carbon.cache import _MetricCache, DrainStrategy, MaxStrategy, RandomStrategy, SortedStrategy
+from carbon.cache import _CreateBacklog, _MetricCache, _ShardedMetricCache, DrainStrategy, \
+    LocalityStrategy, MaxStrategy, RandomStrategy, SortedStrategy, TimeSortedStrategy
 
 
 class MetricCacheTest(TestCase):
@@ -42,6 +43,19 @@ class MetricCacheTest(TestCase):
     self.assertEqual(1, self.metric_cache.size)
     self.assertEqual([(123456, 2.0)], self.metric_cache['foo'].items())
 
+  def test_store_duplicate_out_of_order_timestamp(self):
+    self.metric_cache.store('foo', (123456, 1.0))
+    self.metric_cache.store('foo', (123458, 3.0))
+    self.metric_cache.store('foo', (123456, 2.0))
+    self.assertEqual(2, self.metric_cache.size)
+    self.assertEqual([(123456, 2.0), (123458, 3.0)], self.metric_cache['foo'].items())
+
+  def test_store_truncates_fractional_timestamps(self):
+    self.metric_cache.store('foo', (123456.2, 1.0))
+    self.metric_cache.store('foo', (123456.7, 2.0))
+    self.assertEqual(1, self.metric_cache.size)
+    self.assertEqual([(123456, 2.0)], self.metric_cache['foo'].items())
+
   def test_store_checks_fullness(self):
     is_full_mock = PropertyMock()
     with patch.object(_MetricCache, 'is_full', is_full_mock):
@@ -138,6 +152,39 @@ class MetricCacheTest(TestCase):
       self.metric_cache.store('foo', (123457, 1.0))
       self.assertTrue(self.metric_cache.is_full)
 
+  def test_bytes_tracks_entries(self):
+    self.metric_cache.store('foo', (123456, 1.0))
+    one_point = self.metric_cache.bytes
+    self.assertTrue(one_point > len('foo'))
+    self.metric_cache.store('foo', (123457, 2.0))
+    self.assertTrue(self.metric_cache.bytes > one_point)
+    self.metric_cache.pop('foo')
+    self.assertEqual(0, self.metric_cache.bytes)
+
+  def test_is_full_on_memory(self):
+    self._settings_patch.values['MAX_CACHE_MEMORY'] = 1.0
+    self._settings_patch.start()
+    with patch('carbon.cache.events'):
+      self.assertFalse(self.metric_cache.is_full)
+      self.metric_cache.store('foo', (123456, 1.0))
+      self.assertTrue(self.metric_cache.is_full)
+      self.metric_cache.store('foo', (123457, 1.0))
+      self.assertEqual(1, self.metric_cache.size)
+
+  def test_space_available_below_both_watermarks(self):
+    self._settings_patch.values['CACHE_SIZE_LOW_WATERMARK'] = 10
+    self._settings_patch.values['CACHE_MEMORY_LOW_WATERMARK'] = 1
+    self._settings_patch.start()
+    self.metric_cache.store('foo', (123456, 1.0))
+    self.metric_cache.store('bar', (123456, 1.0))
+    with patch('carbon.cache.state') as state_mock:
+      with patch('carbon.cache.events') as events_mock:
+        state_mock.cacheTooFull = True
+        self.metric_cache.pop('foo')
+        self.assertFalse(events_mock.cacheSpaceAvailable.called)
+        self.metric_cache.pop('bar')
+        self.assertTrue(events_mock.cacheSpaceAvailable.called)
+
   def test_counts_one_datapoint(self):
     self.metric_cache.store('foo', (123456, 1.0))
     self.assertEqual([('foo', 1)], self.metric_cache.counts)
@@ -179,6 +226,23 @@ class DrainStrategyTest(TestCase):
     self.metric_cache.pop('bar')
     self.assertEqual('baz', max_strategy.choose_item())
 
+  def test_max_strategy_empty(self):
+    max_strategy = MaxStrategy(self.metric_cache)
+    self.assertEqual(None, max_strategy.choose_item())
+
+  def test_max_strategy_tracks_pops(self):
+    self.metric_cache.store('foo', (123456, 1.0))
+    self.metric_cache.store('foo', (123457, 2.0))
+    self.metric_cache.store('bar', (123458, 3.0))
+
+    max_strategy = MaxStrategy(self.metric_cache)
+    self.assertEqual('foo', max_strategy.choose_item())
+    self.assertEqual('foo', max_strategy.choose_item())
+    self.metric_cache.pop('foo')
+    self.assertEqual('bar', max_strategy.choose_item())
+    self.metric_cache.pop('bar')
+    self.assertEqual(None, max_strategy.choose_item())
+
   def test_sorted_strategy_static_cache(self):
     self.metric_cache.store('foo', (123456, 1.0))
     self.metric_cache.store('foo', (123457, 2.0))
@@ -217,6 +281,131 @@ class DrainStrategyTest(TestCase):
     self.assertEqual('bar', sorted_strategy.choose_item())
     self.assertEqual('baz', sorted_strategy.choose_item())
 
+  def test_sorted_strategy_defers_new_metrics_to_next_loop(self):
+    self.metric_cache.store('foo', (123456, 1.0))
+    self.metric_cache.store('bar', (123457, 2.0))
+    self.metric_cache.store('bar', (123458, 3.0))
+
+    sorted_strategy = SortedStrategy(self.metric_cache)
+    self.assertEqual('bar', sorted_strategy.choose_item())
+    self.metric_cache.pop('bar')
+
+    # 'baz' is larger than 'foo' but arrived during the loop
+    self.metric_cache.store('baz', (123459, 4.0))
+    self.metric_cache.store('baz', (123460, 5.0))
+    self.assertEqual('foo', sorted_strategy.choose_item())
+    self.assertEqual('baz', sorted_strategy.choose_item())
+
+  def test_sorted_strategy_uses_current_sizes(self):
+    self.metric_cache.store('foo', (123456, 1.0))
+    self.metric_cache.store('bar', (123457, 2.0))
+
+    sorted_strategy = SortedStrategy(self.metric_cache)
+    self.metric_cache.store('bar', (123458, 3.0))
+    self.assertEqual('bar', sorted_strategy.choose_item())
+    self.assertEqual('foo', sorted_strategy.choose_item())
+
+  def test_sorted_strategy_skips_popped_metrics(self):
+    self.metric_cache.store('foo', (123456, 1.0))
+    self.metric_cache.store('foo', (123457, 2.0))
+    self.metric_cache.store('bar', (123458, 3.0))
+
+    sorted_strategy = SortedStrategy(self.metric_cache)
+    self.metric_cache.pop('foo')
+    self.assertEqual('bar', sorted_strategy.choose_item())
+    self.metric_cache.pop('bar')
+    self.assertEqual(None, sorted_strategy.choose_item())
+
+
+class TimeSortedStrategyTest(TestCase):
+  def setUp(self):
+    self._settings_patch = patch.dict('carbon.conf.settings', {'CACHE_WRITE_MAX_AGE': 0})
+    self._settings_patch.start()
+    self.metric_cache = _MetricCache()
+    self.strategy = TimeSortedStrategy(self.metric_cache)
+
+  def tearDown(self):
+    self._settings_patch.stop()
+
+  def _store_at(self, now, metric, datapoint):
+    with patch('carbon.cache.time.time', return_value=now):
+      self.metric_cache.store(metric, datapoint)
+
+  def test_oldest_entry_first(self):
+    self._store_at(100, 'foo', (123456, 1.0))
+    self._store_at(101, 'bar', (123457, 2.0))
+    self._store_at(102, 'bar', (123458, 3.0))
+    self._store_at(103, 'foo', (123459, 4.0))
+    self.assertEqual('foo', self.strategy.choose_item())
+    self.metric_cache.pop('foo')
+    self.assertEqual('bar', self.strategy.choose_item())
+    self.metric_cache.pop('bar')
+    self.assertEqual(None, self.strategy.choose_item())
+
+  def test_recreated_entry_goes_to_back(self):
+    self._store_at(100, 'foo', (123456, 1.0))
+    self._store_at(101, 'bar', (123457, 2.0))
+    self.metric_cache.pop('foo')
+    self._store_at(102, 'foo', (123458, 3.0))
+    self.assertEqual('bar', self.strategy.choose_item())
+    self.metric_cache.pop('bar')
+    self.assertEqual('foo', self.strategy.choose_item())
+
+  def test_max_age_prefers_fullest_until_exceeded(self):
+    self._settings_patch.values['CACHE_WRITE_MAX_AGE'] = 60
+    self._settings_patch.start()
+    self._store_at(100, 'foo', (123456, 1.0))
+    self._store_at(110, 'bar', (123457, 2.0))
+    self._store_at(110, 'bar', (123458, 3.0))
+    with patch('carbon.cache.time.time', return_value=150):
+      self.assertEqual('bar', self.strategy.choose_item())
+    with patch('carbon.cache.time.time', return_value=170):
+      self.assertEqual('foo', self.strategy.choose_item())
+
+
+class LocalityStrategyTest(TestCase):
+  def setUp(self):
+    self.metric_cache = _MetricCache()
+
+  def _store(self, metric, count):
+    for i in range(count):
+      self.metric_cache.store(metric, (123456 + i, 1.0))
+
+  def test_drains_directory_after_fullest_metric(self):
+    self._store('a.x', 1)
+    self._store('b.x', 3)
+    self._store('a.y', 4)
+    self._store('b.y', 1)
+    self._store('b.z', 1)
+
+    strategy = LocalityStrategy(self.metric_cache)
+    chosen = [strategy.choose_item() for _i in range(5)]
+    self.assertEqual('a.y', chosen[0])
+    self.assertEqual('a.x', chosen[1])
+    self.assertEqual('b.x', chosen[2])
+    self.assertEqual(set(['b.y', 'b.z']), set(chosen[3:]))
+
+  def test_every_metric_once_per_loop(self):
+    for metric in ('a.x', 'a.y', 'b.x', 'c.x', 'c.y', 'c.z'):
+      self._store(metric, 1)
+    strategy = LocalityStrategy(self.metric_cache)
+    first_loop = [strategy.choose_item() for _i in range(6)]
+    self.assertEqual(6, len(set(first_loop)))
+    second_loop = [strategy.choose_item() for _i in range(6)]
+    self.assertEqual(set(first_loop), set(second_loop))
+
+  def test_skips_popped_metrics(self):
+    self._store('a.x', 2)
+    self._store('a.y', 1)
+    self._store('b.x', 1)
+    strategy = LocalityStrategy(self.metric_cache)
+    self.assertEqual('a.x', strategy.choose_item())
+    self.metric_cache.pop('a.x')
+    self.metric_cache.pop('a.y')
+    self.assertEqual('b.x', strategy.choose_item())
+    self.metric_cache.pop('b.x')
+    self.assertEqual(None, strategy.choose_item())
+
 
 class RandomStrategyTest(TestCase):
   def setUp(self):
@@ -232,3 +421,119 @@ class RandomStrategyTest(TestCase):
       item = strategy.choose_item()
       self.assertTrue(item in self.metric_cache)
       self.metric_cache.pop(item)
+
+
+class ShardedMetricCacheTest(TestCase):
+  def setUp(self):
+    settings = {
+      'MAX_CACHE_SIZE': float('inf'),
+      'CACHE_SIZE_LOW_WATERMARK': float('inf')
+    }
+    self._settings_patch = patch.dict('carbon.conf.settings', settings)
+    self._settings_patch.start()
+    self.metric_cache = _ShardedMetricCache(SortedStrategy, shard_count=4)
+
+  def tearDown(self):
+    self._settings_patch.stop()
+
+  def test_store_routes_to_one_shard(self):
+    self.metric_cache.store('foo', (123456, 1.0))
+    self.metric_cache.store('foo', (123457, 2.0))
+    holders = [shard for shard in self.metric_cache.shards if 'foo' in shard]
+    self.assertEqual([self.metric_cache.shard_for('foo')], holders)
+    self.assertEqual([(123456, 1.0), (123457, 2.0)], self.metric_cache.get_datapoints('foo'))
+
+  def test_locality_keeps_directories_in_one_shard(self):
+    metric_cache = _ShardedMetricCache(LocalityStrategy, shard_count=4)
+    for i in range(20):
+      metric_cache.store('foo.%d' % i, (123456, 1.0))
+    self.assertEqual([20], [len(shard) for shard in metric_cache.shards if shard])
+
+  def test_size_spans_shards(self):
+    for i in range(20):
+      self.metric_cache.store('foo.%d' % i, (123456, 1.0))
+    self.assertEqual(20, self.metric_cache.size)
+    self.assertEqual(20, len(self.metric_cache))
+    self.metric_cache.pop('foo.3')
+    self.assertEqual(19, self.metric_cache.size)
+
+  def test_is_full_spans_shards(self):
+    self._settings_patch.values['MAX_CACHE_SIZE'] = 3.0
+    self._settings_patch.start()
+    with patch('carbon.cache.events'):
+      for i in range(5):
+        self.metric_cache.store('foo.%d' % i, (123456, 1.0))
+    self.assertEqual(3, self.metric_cache.size)
+    self.assertTrue(self.metric_cache.is_full)
+
+  def test_partition_covers_every_shard_once(self):
+    groups = self.metric_cache.partition(3)
+    shards = [shard for group in groups for shard in group.shards]
+    self.assertEqual(4, len(shards))
+    self.assertEqual(sorted(map(id, self.metric_cache.shards)), sorted(map(id, shards)))
+
+  def test_group_drains_its_shards(self):
+    for i in range(20):
+      self.metric_cache.store('foo.%d' % i, (123456, 1.0))
+    drained = set()
+    for group in self.metric_cache.partition(2):
+      while group:
+        metric, datapoints = group.drain_metric()
+        self.assertEqual([(123456, 1.0)], datapoints)
+        drained.add(metric)
+    self.assertEqual(set('foo.%d' % i for i in range(20)), drained)
+    self.assertFalse(self.metric_cache)
+
+
+class CreateBacklogTest(TestCase):
+  def setUp(self):
+    self._settings_patch = patch.dict('carbon.conf.settings', {'MAX_CREATE_BACKLOG': 3})
+    self._settings_patch.start()
+    self.backlog = _CreateBacklog()
+
+  def tearDown(self):
+    self._settings_patch.stop()
+
+  def test_pop_in_queued_order(self):
+    self.backlog.add('foo', [(123456, 1.0)])
+    self.backlog.add('bar', [(123457, 2.0)])
+    self.assertEqual(('foo', [(123456, 1.0)]), self.backlog.pop())
+    self.assertEqual(('bar', [(123457, 2.0)]), self.backlog.pop())
+    self.assertEqual((None, []), self.backlog.pop())
+
+  def test_add_merges_datapoints(self):
+    self.backlog.add('foo', [(123457, 2.0)])
+    self.backlog.add('foo', [(123456, 1.0), (123457, 3.0)])
+    self.assertEqual(1, len(self.backlog))
+    self.assertEqual(2, self.backlog.size)
+    self.assertEqual(('foo', [(123456, 1.0), (123457, 3.0)]), self.backlog.pop())
+
+  def test_add_refuses_when_full(self):
+    self.assertEqual(0, self.backlog.add('foo', [(123456, 1.0), (123457, 2.0)]))
+    self.assertEqual(1, self.backlog.add('bar', [(123458, 3.0), (123459, 4.0)]))
+    self.assertEqual(1, self.backlog.add('baz', [(123460, 5.0)]))
+    self.assertEqual(3, self.backlog.size)
+
+  def test_datapoints_held_while_creating(self):
+    self.backlog.add('foo', [(123456, 1.0)])
+    self.backlog.pop()
+    self.assertTrue('foo' in self.backlog)
+    self.backlog.add('foo', [(123457, 2.0)])
+    self.assertEqual((None, []), self.backlog.pop())
+    self.assertEqual([(123457, 2.0)], self.backlog.finish('foo'))
+    self.assertTrue('foo' in self.backlog)
+    self.assertEqual([], self.backlog.finish('foo'))
+    self.assertFalse('foo' in self.backlog)
+    self.assertEqual(0, self.backlog.size)
+
+  def test_merge_only_adds_to_queued_metrics(self):
+    self.assertEqual(None, self.backlog.merge('foo', [(123456, 1.0)]))
+    self.assertEqual(0, len(self.backlog))
+    self.backlog.add('foo', [(123456, 1.0)])
+    self.backlog.pop()
+    self.assertEqual(0, self.backlog.merge('foo', [(123457, 2.0)]))
+    self.assertEqual(0, len(self.backlog))
+    requeue = Mock()
+    self.backlog.abort('foo', requeue)
+    requeue.assert_called_once_with('foo', [(123457, 2.0)])
+    self.assertFalse('foo' in self.backlog)
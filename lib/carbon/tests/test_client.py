@@ -7,6 +7,7 @@ import carbon.client as carbon_client
 from carbon.client import CarbonClientFactory
 from carbon.routers import DatapointRouter
 from carbon.tests.util import TestSettings
+from carbon.util import decode_binary
 from carbon import instrumentation
 
 from pickle import loads as pickle_loads
@@ -58,3 +59,42 @@ class ConnectedCarbonClientProtocolTest(TestCase):
     datapoint = ('foo.bar', (1000000000, 1.0))
     self.protocol.sendDatapoint(*datapoint)
     return deferLater(reactor, 0.1, assert_sent)
+
+  @deferred(timeout=1.0)
+  def test_send_datapoint_binary(self):
+    def assert_sent():
+      sent_data = self.transport.value()
+      message_size = unpack(INT32_FORMAT, sent_data[:INT32_SIZE])[0]
+      sent_datapoints = decode_binary(sent_data[INT32_SIZE:INT32_SIZE + message_size])
+      self.assertEqual([datapoint], sent_datapoints)
+
+    carbon_client.settings['DESTINATION_PROTOCOL'] = 'binary'
+    datapoint = ('foo.bar', (1000000000, 1.0))
+    self.protocol.sendDatapoint(*datapoint)
+    return deferLater(reactor, 0.1, assert_sent)
+
+
+@patch('carbon.state.instrumentation', Mock(spec=instrumentation))
+class CarbonClientFactorySendDatapointsTest(TestCase):
+  def setUp(self):
+    carbon_client.settings = TestSettings()  # reset to defaults
+    carbon_client.settings['MAX_QUEUE_SIZE'] = 3
+    self.factory = CarbonClientFactory(('127.0.0.1', 0, 'a'))
+
+  def tearDown(self):
+    carbon_client.settings = TestSettings()
+
+  def test_queues_batch(self):
+    datapoints = [('foo', (1000000000, 1.0)), ('bar', (1000000000, 2.0))]
+    self.factory.sendDatapoints(datapoints)
+    self.assertEqual(datapoints, list(self.factory.queue))
+    self.assertFalse(self.factory.queueFull.called)
+
+  def test_drops_beyond_max_queue_size(self):
+    datapoints = [('foo', (1000000000 + i, 1.0)) for i in range(5)]
+    with patch.object(self.factory, 'queueFullCallback') as callback_mock:
+      self.factory.queueFull = carbon_client.Deferred()
+      self.factory.queueFull.addCallback(callback_mock)
+      self.factory.sendDatapoints(datapoints)
+    self.assertEqual(datapoints[:3], list(self.factory.queue))
+    self.assertTrue(self.factory.queueFull.called)
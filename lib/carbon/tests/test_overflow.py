@@ -0,0 +1,84 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from mock import patch
+
+from carbon.cache import _MetricCache
+from carbon.overflow import CacheOverflow
+
+
+class CacheOverflowTest(TestCase):
+  def setUp(self):
+    settings = {
+      'MAX_CACHE_SIZE': 2,
+      'MAX_CACHE_MEMORY': float('inf'),
+      'CACHE_SIZE_LOW_WATERMARK': float('inf'),
+      'CACHE_MEMORY_LOW_WATERMARK': float('inf'),
+      'MAX_CACHE_OVERFLOW_SIZE': 1024,
+    }
+    self._settings_patch = patch.dict('carbon.conf.settings', settings)
+    self._settings_patch.start()
+    self.directory = tempfile.mkdtemp()
+    self.overflow = CacheOverflow(self.directory, 'carbon-cache-a')
+    self._state_patch = patch('carbon.state.cache_overflow', self.overflow)
+    self._state_patch.start()
+    self.metric_cache = _MetricCache()
+
+  def tearDown(self):
+    self._state_patch.stop()
+    self._settings_patch.stop()
+    shutil.rmtree(self.directory)
+
+  def test_full_cache_spills_to_overflow(self):
+    self.metric_cache.store('foo', (123456, 1.0))
+    self.metric_cache.store('foo', (123457, 2.0))
+    self.metric_cache.store('bar', (123458, 3.0))
+    self.assertEqual(2, self.metric_cache.size)
+    self.assertTrue(len(self.overflow) > 0)
+
+  def test_merge_restores_points_once_space_frees(self):
+    self.metric_cache.store('foo', (123456, 1.0))
+    self.metric_cache.store('foo', (123457, 2.0))
+    self.metric_cache.store('bar', (123458, 3.0))
+    self.metric_cache.store('bar', (123459, 4.0))
+    self.assertEqual(0, self.overflow.merge(self.metric_cache))
+
+    self.metric_cache.pop('foo')
+    self.assertEqual(2, self.overflow.merge(self.metric_cache))
+    self.assertEqual([(123458, 3.0), (123459, 4.0)], self.metric_cache.get_datapoints('bar'))
+    self.assertEqual(0, len(self.overflow))
+    self.assertEqual(0, os.path.getsize(self.overflow.path))
+
+  def test_merge_stops_when_cache_fills(self):
+    self.metric_cache.store('foo', (123456, 1.0))
+    self.metric_cache.store('foo', (123457, 2.0))
+    self.metric_cache.store('bar', (123458, 3.0))
+    self.metric_cache.store('bar', (123459, 4.0))
+    self.metric_cache.store('bar', (123460, 5.0))
+
+    self.metric_cache.pop('foo')
+    self.assertEqual(2, self.overflow.merge(self.metric_cache))
+    self.assertTrue(len(self.overflow) > 0)
+    self.metric_cache.pop('bar')
+    self.assertEqual(1, self.overflow.merge(self.metric_cache))
+    self.assertEqual([(123460, 5.0)], self.metric_cache.get_datapoints('bar'))
+
+  def test_drops_when_overflow_is_full(self):
+    self._settings_patch.values['MAX_CACHE_OVERFLOW_SIZE'] = 0
+    self._settings_patch.start()
+    self.metric_cache.store('foo', (123456, 1.0))
+    self.metric_cache.store('foo', (123457, 2.0))
+    self.metric_cache.store('bar', (123458, 3.0))
+    self.assertEqual(0, len(self.overflow))
+
+  def test_pending_points_survive_restart(self):
+    self.metric_cache.store('foo', (123456, 1.0))
+    self.metric_cache.store('foo', (123457, 2.0))
+    self.metric_cache.store('bar', (123458, 3.0))
+    self.overflow.close()
+
+    overflow = CacheOverflow(self.directory, 'carbon-cache-a')
+    self.metric_cache.pop('foo')
+    self.assertEqual(1, overflow.merge(self.metric_cache))
+    self.assertEqual([(123458, 3.0)], self.metric_cache.get_datapoints('bar'))
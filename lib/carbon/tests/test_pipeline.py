@@ -1,7 +1,7 @@
 from unittest import TestCase
 from mock import MagicMock, patch
 
-from carbon.pipeline import Processor, run_pipeline
+from carbon.pipeline import Processor, run_pipeline, run_pipeline_batch
 
 
 class ProcessorTest(TestCase):
@@ -28,3 +28,30 @@ class ProcessorTest(TestCase):
     with patch.object(carbon.pipeline.state, 'pipeline_processors', [processor_mock]):
       run_pipeline("carbon.metric", (0, 0))
     processor_mock.process.assert_called_once_with("carbon.metric", (0, 0))
+
+  def test_process_batch_defaults_to_process(self):
+    class DoublingProcessor(Processor):
+      def process(self, metric, datapoint):
+        yield (metric, datapoint)
+        yield (metric + '.copy', datapoint)
+
+    self.assertEqual(
+      [('foo', (0, 0)), ('foo.copy', (0, 0)), ('bar', (1, 1)), ('bar.copy', (1, 1))],
+      DoublingProcessor().process_batch([('foo', (0, 0)), ('bar', (1, 1))]))
+
+  def test_run_pipeline_batch(self):
+    first_mock = MagicMock(Processor)
+    first_mock.process_batch.return_value = [("carbon.rewritten", (0, 0))]
+    second_mock = MagicMock(Processor)
+
+    run_pipeline_batch([("carbon.metric", (0, 0))], [first_mock, second_mock])
+    first_mock.process_batch.assert_called_once_with([("carbon.metric", (0, 0))])
+    second_mock.process_batch.assert_called_once_with([("carbon.rewritten", (0, 0))])
+
+  def test_run_pipeline_batch_stops_without_output(self):
+    first_mock = MagicMock(Processor)
+    first_mock.process_batch.return_value = []
+    second_mock = MagicMock(Processor)
+
+    run_pipeline_batch([("carbon.metric", (0, 0))], [first_mock, second_mock])
+    self.assertFalse(second_mock.process_batch.called)
@@ -0,0 +1,146 @@
+import re
+from unittest import TestCase
+from mock import Mock, patch
+
+from twisted.test.proto_helpers import StringTransport
+
+from carbon.util import encode_binary, get_unpickler, pickle
+
+from carbon.protocols import MetricBinaryReceiver, MetricLineReceiver, MetricPickleReceiver, \
+    MetricReceiver
+
+
+class MetricLineReceiverTest(TestCase):
+  def setUp(self):
+    self.receiver = MetricLineReceiver()
+    self.receiver.transport = StringTransport()
+    self.receiver.peerName = 'peer'
+    self.metrics = []
+    self.receiver.metricsReceived = self.metrics.extend
+
+  def test_parses_chunk_in_one_batch(self):
+    self.receiver.metricsReceived = Mock()
+    self.receiver.dataReceived('foo 1 123456\nbar 2.5 123457\n')
+    self.receiver.metricsReceived.assert_called_once_with(
+      [('foo', (123456.0, 1.0)), ('bar', (123457.0, 2.5))])
+
+  def test_keeps_partial_line(self):
+    self.receiver.dataReceived('foo 1 123456\nbar 2')
+    self.assertEqual([('foo', (123456.0, 1.0))], self.metrics)
+    self.receiver.dataReceived('.5 123457\r\n')
+    self.assertEqual([('foo', (123456.0, 1.0)), ('bar', (123457.0, 2.5))], self.metrics)
+
+  @patch('carbon.instrumentation.increment')
+  def test_counts_invalid_lines(self, increment_mock):
+    self.receiver.dataReceived('foo 1 123456\nfoo 1\nbar x 123457\nbaz 3 123458\n')
+    self.assertEqual(['foo', 'baz'], [metric for metric, _datapoint in self.metrics])
+    increment_mock.assert_called_once_with('invalidLines', 2)
+
+  @patch('carbon.instrumentation.increment')
+  def test_non_finite_timestamps_are_invalid(self, increment_mock):
+    self.receiver.dataReceived('a.b 1 100\nc.d 2 nan\ne.f 3 300\ng.h 4 1e999\n')
+    self.assertEqual([('a.b', (100.0, 1.0)), ('e.f', (300.0, 3.0))], self.metrics)
+    increment_mock.assert_called_once_with('invalidLines', 2)
+
+  def test_line_too_long(self):
+    self.receiver.MAX_LENGTH = 10
+    self.receiver.dataReceived('foo 1 123456\n' + 'x' * 11)
+    self.assertTrue(self.receiver.transport.disconnecting)
+
+  def test_complete_line_too_long(self):
+    self.receiver.MAX_LENGTH = 12
+    self.receiver.dataReceived('foo 1 123456\n' + 'x' * 13 + '\nbar 2 123457\n')
+    self.assertEqual([('foo', (123456.0, 1.0))], self.metrics)
+    self.assertTrue(self.receiver.transport.disconnecting)
+
+
+class MetricPickleReceiverTest(TestCase):
+  def setUp(self):
+    self.receiver = MetricPickleReceiver()
+    self.receiver.peerName = 'peer'
+    self.receiver.unpickler = get_unpickler()
+    self.receiver.metricsReceived = Mock()
+
+  def test_coerces_batch(self):
+    data = pickle.dumps([('foo', (123456, '1')), ('bar', ('123457', 2)), ('baz', ('x', 3))])
+    self.receiver.stringReceived(data)
+    self.receiver.metricsReceived.assert_called_once_with(
+      [('foo', (123456.0, 1.0)), ('bar', (123457.0, 2.0))])
+
+  def test_non_finite_timestamps_are_dropped(self):
+    data = pickle.dumps([('foo', (123456, 1)), ('bar', ('nan', 2)), ('baz', (float('inf'), 3))])
+    self.receiver.stringReceived(data)
+    self.receiver.metricsReceived.assert_called_once_with([('foo', (123456.0, 1.0))])
+
+
+class MetricBinaryReceiverTest(TestCase):
+  def setUp(self):
+    self.receiver = MetricBinaryReceiver()
+    self.receiver.peerName = 'peer'
+    self.receiver.metricsReceived = Mock()
+
+  def test_round_trip(self):
+    datapoints = [
+      ('foo.bar', (123456, 1.5)),
+      ('foo.baz', (123456, -2.0)),
+      ('foo.bar', (123457.9, 3.0)),
+    ]
+    self.receiver.stringReceived(encode_binary(datapoints))
+    self.receiver.metricsReceived.assert_called_once_with([
+      ('foo.bar', (123456, 1.5)),
+      ('foo.baz', (123456, -2.0)),
+      ('foo.bar', (123457, 3.0)),
+    ])
+
+  def test_empty_message(self):
+    self.receiver.stringReceived(encode_binary([]))
+    self.receiver.metricsReceived.assert_called_once_with([])
+
+  def test_truncated_message_is_ignored(self):
+    data = encode_binary([('foo.bar', (123456, 1.5))])
+    for length in (2, 8, len(data) - 1):
+      self.receiver.stringReceived(data[:length])
+    self.assertFalse(self.receiver.metricsReceived.called)
+
+  def test_unknown_name_index_is_ignored(self):
+    data = encode_binary([('foo.bar', (123456, 1.5))])
+    # Point the record at a second name that is not in the message
+    data = data[:-20] + '\x00\x00\x00\x01' + data[-16:]
+    self.receiver.stringReceived(data)
+    self.assertFalse(self.receiver.metricsReceived.called)
+
+
+class MetricReceiverTest(TestCase):
+  @patch('carbon.events.metricsReceived')
+  def test_metrics_received_as_one_batch(self, event_mock):
+    receiver = MetricReceiver()
+    receiver.metricsReceived([
+      ('foo', (123456.0, 1.0)),
+      ('bar', (123456.0, float('nan'))),
+      ('baz', (123457.0, 2.0)),
+    ])
+    event_mock.assert_called_once_with([('foo', (123456.0, 1.0)), ('baz', (123457.0, 2.0))])
+
+  @patch('carbon.events.metricsReceived')
+  def test_non_finite_timestamp_does_not_discard_batch(self, event_mock):
+    MetricReceiver().metricsReceived([
+      ('foo', (123456.0, 1.0)),
+      ('bar', (float('nan'), 1.0)),
+      ('baz', (float('inf'), 1.0)),
+      ('qux', (123457.0, 2.0)),
+    ])
+    event_mock.assert_called_once_with([('foo', (123456.0, 1.0)), ('qux', (123457.0, 2.0))])
+
+  @patch('carbon.instrumentation.increment')
+  @patch('carbon.events.metricsReceived')
+  def test_blacklist(self, event_mock, increment_mock):
+    with patch('carbon.protocols.BlackList.regex_list', [re.compile('^bar')]):
+      MetricReceiver().metricsReceived([('foo', (123456.0, 1.0)), ('bar', (123456.0, 1.0))])
+    event_mock.assert_called_once_with([('foo', (123456.0, 1.0))])
+    increment_mock.assert_called_once_with('blacklistMatches')
+
+  @patch('time.time', Mock(return_value=123460.0))
+  @patch('carbon.events.metricsReceived')
+  def test_missing_timestamp_uses_current_time(self, event_mock):
+    MetricReceiver().metricReceived('foo', (-1, 1.0))
+    event_mock.assert_called_once_with([('foo', (123460.0, 1.0))])
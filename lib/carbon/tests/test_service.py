@@ -3,8 +3,8 @@ from mock import Mock, patch
 from unittest import TestCase
 
 from carbon import events, state
-from carbon.pipeline import Processor, run_pipeline
-from carbon.service import CarbonRootService, setupPipeline
+from carbon.pipeline import Processor, run_pipeline, run_pipeline_batch
+from carbon.service import CarbonRootService, createBaseService, setupPipeline
 from carbon.tests.util import TestSettings
 
 
@@ -20,6 +20,8 @@ class TestSetupPipeline(TestCase):
     state.pipeline_processors = []
     events.metricReceived.handlers = []
     events.metricGenerated.handlers = []
+    events.metricsReceived.removeHandler(run_pipeline_batch)
+    events.metricsGenerated.removeHandler(run_pipeline_batch)
 
   def test_run_pipeline_chained_to_metric_received(self):
     setupPipeline([], self.root_service_mock, self.settings)
@@ -29,6 +31,11 @@ class TestSetupPipeline(TestCase):
     setupPipeline([], self.root_service_mock, self.settings)
     self.assertTrue(run_pipeline in events.metricGenerated.handlers)
 
+  def test_run_pipeline_batch_chained_to_batch_events(self):
+    setupPipeline([], self.root_service_mock, self.settings)
+    self.assertTrue(run_pipeline_batch in events.metricsReceived.handlers)
+    self.assertTrue(run_pipeline_batch in events.metricsGenerated.handlers)
+
   @patch('carbon.service.setupAggregatorProcessor')
   def test_aggregate_processor_set_up(self, setup_mock):
     setupPipeline(['aggregate'], self.root_service_mock, self.settings)
@@ -64,3 +71,29 @@ class TestSetupPipeline(TestCase):
   def test_schedules_pipeline_ready(self):
     setupPipeline([], self.root_service_mock, self.settings)
     self.assertTrue(self.call_when_running_mock.called)
+
+
+class TestCreateBaseService(TestCase):
+  def setUp(self):
+    self.settings = TestSettings()
+    self.settings['program'] = 'carbon-relay'
+    self.settings['RECEIVER_PROCESSES'] = 2
+    self.mocks = {}
+    for name in ('setupReceiverWorkers', 'setupAMQPListener', 'setupManhole'):
+      p = patch('carbon.service.%s' % name)
+      self.mocks[name] = p.start()
+      self.addCleanup(p.stop)
+
+  def test_supervisor_runs_unshared_listeners(self):
+    self.settings['receiver_worker'] = None
+    createBaseService(None, self.settings)
+    self.assertTrue(self.mocks['setupReceiverWorkers'].called)
+    self.assertTrue(self.mocks['setupAMQPListener'].called)
+    self.assertTrue(self.mocks['setupManhole'].called)
+
+  def test_worker_runs_only_receivers(self):
+    self.settings['receiver_worker'] = 1
+    createBaseService(None, self.settings)
+    self.assertTrue(self.mocks['setupReceiverWorkers'].called)
+    self.assertFalse(self.mocks['setupAMQPListener'].called)
+    self.assertFalse(self.mocks['setupManhole'].called)
@@ -0,0 +1,266 @@
+import os
+import shutil
+import tempfile
+from errno import ENOENT
+from unittest import TestCase
+from mock import patch
+
+# carbon.storage locates its config files at import
+with patch.dict('carbon.conf.settings', {'CONF_DIR': '/nonexistent'}):
+  from carbon.storage import _OpenFiles, Archive, DefaultSchema, DirtyFiles, KnownDirectories, \
+      KnownFiles, ListSchema, PatternSchema, SchemaMatcher
+
+
+def pattern(name, regex):
+  return PatternSchema(name, regex, [Archive(60, 1440)])
+
+
+class SchemaMatcherTest(TestCase):
+  def setUp(self):
+    self.default = DefaultSchema('default', [Archive(60, 1440)])
+
+  def test_first_matching_pattern_wins(self):
+    schemas = [pattern('late', 'bar$'), pattern('early', '^foo'), self.default]
+    matcher = SchemaMatcher(schemas)
+    # 'early' matches at an earlier position, but 'late' comes first
+    self.assertEqual('late', matcher.match('foo.bar').name)
+    self.assertEqual('early', matcher.match('foo.baz').name)
+    self.assertEqual('default', matcher.match('baz').name)
+
+  def test_patterns_with_groups(self):
+    schemas = [pattern('grouped', r'^(a|b)\.(c)'), pattern('other', 'x'), self.default]
+    matcher = SchemaMatcher(schemas)
+    self.assertEqual('grouped', matcher.match('b.c').name)
+    self.assertEqual('other', matcher.match('b.x').name)
+
+  def test_uncombinable_patterns_fall_back(self):
+    schemas = [pattern('backref', r'^(\w+)\.\1$'), pattern('flags', '(?i)^FOO'), self.default]
+    matcher = SchemaMatcher(schemas)
+    self.assertEqual('backref', matcher.match('abc.abc').name)
+    self.assertEqual('flags', matcher.match('foo.abc').name)
+    self.assertEqual('default', matcher.match('abc.def').name)
+
+  def test_many_patterns(self):
+    schemas = [pattern('p%d' % i, r'^metric%d\.(x)$' % i) for i in range(200)]
+    matcher = SchemaMatcher(schemas + [self.default])
+    self.assertEqual('p150', matcher.match('metric150.x').name)
+    self.assertEqual('default', matcher.match('metric150.y').name)
+
+  def test_matches_are_memoized(self):
+    schema = pattern('foo', '^foo')
+    matcher = SchemaMatcher([schema, self.default], cache_size=1)
+    matcher.match('foo.bar')
+    with patch.object(matcher, 'steps', []):
+      self.assertEqual('foo', matcher.match('foo.bar').name)
+    matcher.match('foo.baz')
+    with patch.object(matcher, 'steps', []):
+      self.assertEqual('foo', matcher.match('foo.baz').name)
+      self.assertEqual(None, matcher.match('foo.bar'))
+
+  def test_list_schema_matches_are_not_memoized(self):
+    with patch.dict('carbon.conf.settings', {'WHITELISTS_DIR': '/nonexistent'}):
+      schema = ListSchema('listed', 'listed', [Archive(60, 1440)])
+    matcher = SchemaMatcher([schema, self.default])
+    self.assertEqual('default', matcher.match('foo').name)
+    schema.members = frozenset(['foo'])
+    with patch('carbon.storage.exists', return_value=False):
+      self.assertEqual('listed', matcher.match('foo').name)
+
+  def test_equality_follows_definitions(self):
+    self.assertEqual(SchemaMatcher([pattern('foo', '^foo'), self.default]),
+                     SchemaMatcher([pattern('foo', '^foo'), self.default]))
+    self.assertNotEqual(SchemaMatcher([pattern('foo', '^foo'), self.default]),
+                        SchemaMatcher([pattern('foo', '^bar'), self.default]))
+
+
+class KnownFilesTest(TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.known_files = KnownFiles()
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def _touch(self, *parts):
+    path = os.path.join(self.directory, *parts)
+    if not os.path.isdir(os.path.dirname(path)):
+      os.makedirs(os.path.dirname(path))
+    open(path, 'w').close()
+    return path
+
+  def test_scan(self):
+    self._touch('foo.wsp')
+    self._touch('servers', 'web01', 'cpu.wsp')
+    self._touch('servers', 'web01', 'notes.txt')
+    self.known_files.scan(self.directory)
+    self.assertEqual(set(['foo', 'servers.web01.cpu']), self.known_files.metrics)
+
+  def test_exists_falls_back_to_stat(self):
+    path = os.path.join(self.directory, 'foo.wsp')
+    self.assertFalse(self.known_files.exists('foo', path))
+    self._touch('foo.wsp')
+    self.assertTrue(self.known_files.exists('foo', path))
+    with patch('carbon.storage.exists') as exists_mock:
+      self.assertTrue(self.known_files.exists('foo', path))
+      self.assertFalse(exists_mock.called)
+
+  def test_discard(self):
+    path = self._touch('foo.wsp')
+    self.known_files.add('foo')
+    os.unlink(path)
+    self.known_files.discard('foo')
+    self.assertFalse(self.known_files.exists('foo', path))
+
+
+class KnownDirectoriesTest(TestCase):
+  def setUp(self):
+    self.directory = tempfile.mkdtemp()
+    self.known_directories = KnownDirectories(2)
+
+  def tearDown(self):
+    shutil.rmtree(self.directory)
+
+  def test_ensure_makes_directory_once(self):
+    path = os.path.join(self.directory, 'foo', 'bar')
+    self.known_directories.ensure(path)
+    self.assertTrue(os.path.isdir(path))
+    with patch('os.makedirs') as makedirs_mock:
+      self.known_directories.ensure(path)
+      self.assertFalse(makedirs_mock.called)
+
+  def test_existing_directory(self):
+    self.known_directories.ensure(self.directory)
+    self.assertEqual(1, len(self.known_directories))
+
+  def test_least_recently_used_is_forgotten(self):
+    paths = [os.path.join(self.directory, name) for name in ('a', 'b', 'c')]
+    for path in paths:
+      self.known_directories.ensure(path)
+    self.assertEqual(2, len(self.known_directories))
+    self.assertEqual(paths[1:], list(self.known_directories.directories))
+
+
+class OpenFilesTest(TestCase):
+  def setUp(self):
+    settings = {
+      'MAX_OPEN_DATABASE_FILES': 2,
+      'OPEN_DATABASE_FILE_MAX_AGE': 60,
+    }
+    self._settings_patch = patch.dict('carbon.conf.settings', settings)
+    self._settings_patch.start()
+    self.directory = tempfile.mkdtemp()
+    self.open_files = _OpenFiles()
+    self.paths = []
+    for name in ('a', 'b', 'c'):
+      path = os.path.join(self.directory, name + '.wsp')
+      open(path, 'w').close()
+      self.paths.append(path)
+
+  def tearDown(self):
+    self.open_files.close_all()
+    self._settings_patch.stop()
+    shutil.rmtree(self.directory)
+
+  def test_checkout_reuses_handle(self):
+    entry = self.open_files.checkout(self.paths[0])
+    self.open_files.checkin(self.paths[0], entry)
+    self.assertTrue(self.open_files.checkout(self.paths[0]) is entry)
+
+  def test_checkout_is_exclusive(self):
+    entry = self.open_files.checkout(self.paths[0])
+    self.open_files.checkin(self.paths[0], entry)
+    self.open_files.checkout(self.paths[0])
+    self.assertFalse(self.open_files.checkout(self.paths[0]) is entry)
+
+  def test_least_recently_used_is_closed(self):
+    entries = []
+    for path in self.paths:
+      entry = self.open_files.checkout(path)
+      self.open_files.checkin(path, entry)
+      entries.append(entry)
+    self.assertEqual(2, len(self.open_files))
+    self.assertTrue(entries[0][0].closed)
+    self.assertFalse(entries[2][0].closed)
+
+  def test_old_handles_are_reopened(self):
+    entry = self.open_files.checkout(self.paths[0])
+    self.open_files.checkin(self.paths[0], (entry[0], entry[1] - 61))
+    self.assertFalse(self.open_files.checkout(self.paths[0])[0] is entry[0])
+    self.assertTrue(entry[0].closed)
+
+  def test_removed_file_is_not_written(self):
+    entry = self.open_files.checkout(self.paths[0])
+    self.open_files.checkin(self.paths[0], entry)
+    os.unlink(self.paths[0])
+    try:
+      self.open_files.checkout(self.paths[0])
+    except IOError, e:
+      self.assertEqual(ENOENT, e.errno)
+    else:
+      self.fail("IOError not raised")
+    self.assertTrue(entry[0].closed)
+
+  def test_replaced_file_is_reopened(self):
+    entry = self.open_files.checkout(self.paths[0])
+    self.open_files.checkin(self.paths[0], entry)
+    os.rename(self.paths[1], self.paths[0])
+    new_entry = self.open_files.checkout(self.paths[0])
+    self.assertFalse(new_entry[0] is entry[0])
+    self.assertTrue(entry[0].closed)
+    self.assertEqual(os.stat(self.paths[0]).st_ino, os.fstat(new_entry[0].fileno()).st_ino)
+    new_entry[0].close()
+
+  def test_invalidate(self):
+    entry = self.open_files.checkout(self.paths[0])
+    self.open_files.checkin(self.paths[0], entry)
+    self.open_files.invalidate(self.paths[0])
+    self.assertTrue(entry[0].closed)
+    self.assertEqual(0, len(self.open_files))
+
+  def test_capacity_respects_descriptor_limit(self):
+    self._settings_patch.values['MAX_OPEN_DATABASE_FILES'] = 10 ** 9
+    self._settings_patch.start()
+    with patch('resource.getrlimit', return_value=(1024, 4096)):
+      self.assertEqual(512, self.open_files._capacity())
+
+
+class DirtyFilesTest(TestCase):
+  def setUp(self):
+    settings = {
+      'WHISPER_SYNC_INTERVAL': 60,
+      'WHISPER_SYNC_MAX_DIRTY_FILES': 2,
+    }
+    self._settings_patch = patch.dict('carbon.conf.settings', settings)
+    self._settings_patch.start()
+    self.directory = tempfile.mkdtemp()
+    self.dirty_files = DirtyFiles()
+
+  def tearDown(self):
+    self._settings_patch.stop()
+    shutil.rmtree(self.directory)
+
+  def _path(self, name):
+    path = os.path.join(self.directory, name)
+    open(path, 'w').close()
+    return path
+
+  def test_due_after_max_dirty_files(self):
+    self.assertFalse(self.dirty_files.add(self._path('a')))
+    self.assertFalse(self.dirty_files.add(self._path('a')))
+    self.assertTrue(self.dirty_files.add(self._path('b')))
+    self.assertTrue(self.dirty_files.ready.is_set())
+
+  def test_due_after_interval(self):
+    self.dirty_files.last_sync -= 61
+    self.assertTrue(self.dirty_files.add(self._path('a')))
+
+  def test_sync(self):
+    paths = [self._path('a'), self._path('b')]
+    for path in paths:
+      self.dirty_files.add(path)
+    os.unlink(paths[1])
+    with patch('carbon.storage.fdatasync') as fdatasync:
+      self.assertEqual(2, self.dirty_files.sync())
+    self.assertEqual(1, fdatasync.call_count)
+    self.assertEqual(0, len(self.dirty_files))
+    self.assertFalse(self.dirty_files.ready.is_set())
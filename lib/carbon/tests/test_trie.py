@@ -0,0 +1,65 @@
+from unittest import TestCase
+
+from carbon.cache import _MetricCache
+from carbon.trie import MetricTrie, expand_braces
+
+
+class ExpandBracesTest(TestCase):
+  def test_no_braces(self):
+    self.assertEqual(['foo*'], expand_braces('foo*'))
+
+  def test_alternatives(self):
+    self.assertEqual(['ab', 'ac'], expand_braces('a{b,c}'))
+
+  def test_multiple_groups(self):
+    self.assertEqual(['ac', 'ad', 'bc', 'bd'], expand_braces('{a,b}{c,d}'))
+
+
+class MetricTrieTest(TestCase):
+  def setUp(self):
+    self.trie = MetricTrie([
+      'servers.web01.cpu.user',
+      'servers.web01.cpu.system',
+      'servers.web02.cpu.user',
+      'servers.db01.disk',
+    ])
+
+  def test_find_exact(self):
+    self.assertEqual([('servers.db01.disk', True)], self.trie.find('servers.db01.disk'))
+
+  def test_find_branch(self):
+    self.assertEqual([('servers.web01.cpu', False)], self.trie.find('servers.web01.cpu'))
+
+  def test_find_wildcard(self):
+    self.assertEqual(
+      ['servers.web01.cpu.user', 'servers.web02.cpu.user'],
+      sorted(path for path, _leaf in self.trie.find('servers.*.cpu.user')))
+
+  def test_find_braces_and_ranges(self):
+    self.assertEqual(
+      ['servers.web01.cpu.system', 'servers.web01.cpu.user'],
+      sorted(path for path, _leaf in self.trie.find('servers.web0[1].cpu.{user,system}')))
+
+  def test_find_no_match(self):
+    self.assertEqual([], self.trie.find('servers.*.memory'))
+    self.assertEqual([], self.trie.find('servers.web01.cpu.user.extra'))
+
+  def test_remove_prunes_empty_branches(self):
+    self.trie.remove('servers.db01.disk')
+    self.assertEqual([], self.trie.find('servers.db01'))
+    self.assertEqual(['servers.web01', 'servers.web02'],
+                     sorted(path for path, _leaf in self.trie.find('servers.*')))
+
+  def test_remove_keeps_shared_branches(self):
+    self.trie.remove('servers.web01.cpu.user')
+    self.assertEqual([('servers.web01.cpu.system', True)], self.trie.find('servers.web01.cpu.*'))
+
+  def test_tracks_cache(self):
+    cache = _MetricCache()
+    trie = MetricTrie()
+    cache.watch(trie)
+    cache.store('foo.bar', (123456, 1.0))
+    cache.store('foo.bar', (123457, 2.0))
+    self.assertEqual([('foo.bar', True)], trie.find('foo.*'))
+    cache.pop('foo.bar')
+    self.assertEqual([], trie.find('foo.*'))
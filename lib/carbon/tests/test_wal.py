@@ -0,0 +1,161 @@
+import os
+import shutil
+import tempfile
+from unittest import TestCase
+from mock import patch
+
+from carbon.cache import _CreateBacklog, _ShardedMetricCache, SortedStrategy
+from carbon.wal import WriteAheadLog
+
+
+class WriteAheadLogTest(TestCase):
+  def setUp(self):
+    settings = {
+      'MAX_CACHE_SIZE': float('inf'),
+      'CACHE_SIZE_LOW_WATERMARK': float('inf'),
+      'CACHE_WAL_MAX_SEGMENT_SIZE': 64 * 1024 * 1024,
+    }
+    self._settings_patch = patch.dict('carbon.conf.settings', settings)
+    self._settings_patch.start()
+    self.directory = tempfile.mkdtemp()
+
+  def tearDown(self):
+    self._settings_patch.stop()
+    shutil.rmtree(self.directory)
+
+  def _start(self):
+    cache = _ShardedMetricCache(SortedStrategy, shard_count=2)
+    wal = WriteAheadLog(self.directory, 'carbon-cache-a')
+    for shard in cache.shards:
+      shard.watch(wal)
+    self.backlog = _CreateBacklog()
+    self.backlog.watch(wal)
+    wal.recover(cache)
+    return cache, wal
+
+  def _feed(self, cache, wal, metric, datapoint):
+    wal.write(metric, datapoint)
+    cache.store(metric, datapoint)
+
+  def test_recover_replays_journal_after_crash(self):
+    cache, wal = self._start()
+    self._feed(cache, wal, 'foo', (123456, 1.0))
+    self._feed(cache, wal, 'foo', (123457, 2.0))
+    self._feed(cache, wal, 'bar', (123458, 3.0))
+    wal.sync()
+
+    cache, wal = self._start()
+    self.assertEqual([(123456, 1.0), (123457, 2.0)], cache.get_datapoints('foo'))
+    self.assertEqual([(123458, 3.0)], cache.get_datapoints('bar'))
+
+  def test_close_moves_cache_to_snapshot(self):
+    cache, wal = self._start()
+    self._feed(cache, wal, 'foo', (123456, 1.0))
+    self._feed(cache, wal, 'bar', (123458, 3.0))
+    wal.close(cache)
+    self.assertFalse(cache)
+    self.assertEqual(['carbon-cache-a.snapshot'], os.listdir(self.directory))
+
+    cache, wal = self._start()
+    self.assertEqual([(123456, 1.0)], cache.get_datapoints('foo'))
+    self.assertEqual([(123458, 3.0)], cache.get_datapoints('bar'))
+
+  def test_segments_removed_once_popped(self):
+    self._settings_patch.values['CACHE_WAL_MAX_SEGMENT_SIZE'] = 1
+    self._settings_patch.start()
+    cache, wal = self._start()
+    self._feed(cache, wal, 'foo', (123456, 1.0))
+    wal.sync()
+    self._feed(cache, wal, 'bar', (123458, 3.0))
+    wal.sync()
+    self.assertEqual([1, 2, 3], wal.existing_segments())
+
+    cache.pop('bar')
+    wal.sync()
+    self.assertEqual([1, 2, 3], wal.existing_segments())
+
+    cache.pop('foo')
+    wal.sync()
+    self.assertEqual([3], wal.existing_segments())
+
+  def test_recovered_datapoints_survive_second_crash(self):
+    self._settings_patch.values['CACHE_WAL_MAX_SEGMENT_SIZE'] = 1
+    self._settings_patch.start()
+    cache, wal = self._start()
+    self._feed(cache, wal, 'foo', (123456, 1.0))
+    wal.sync()
+    self._feed(cache, wal, 'bar', (123458, 3.0))
+    wal.sync()
+
+    cache, wal = self._start()
+    wal.sync()
+    self.assertEqual([1, 2, 3, 4], wal.existing_segments())
+
+    cache, wal = self._start()
+    self.assertEqual([(123456, 1.0)], cache.get_datapoints('foo'))
+    self.assertEqual([(123458, 3.0)], cache.get_datapoints('bar'))
+
+  def test_restored_datapoints_survive_crash(self):
+    self._settings_patch.values['CACHE_WAL_MAX_SEGMENT_SIZE'] = 1
+    self._settings_patch.start()
+    cache, wal = self._start()
+    self._feed(cache, wal, 'foo', (123456, 1.0))
+    wal.sync()
+    cache.restore('foo', cache.pop('foo'))
+    wal.sync()
+    self.assertEqual([1, 2], wal.existing_segments())
+
+    cache, wal = self._start()
+    self.assertEqual([(123456, 1.0)], cache.get_datapoints('foo'))
+
+  def test_backlogged_datapoints_survive_crash(self):
+    self._settings_patch.values.update({'CACHE_WAL_MAX_SEGMENT_SIZE': 1, 'MAX_CREATE_BACKLOG': 100})
+    self._settings_patch.start()
+    cache, wal = self._start()
+    self._feed(cache, wal, 'foo', (123456, 1.0))
+    wal.sync()
+    self.backlog.add('foo', cache.pop('foo'))
+    self._feed(cache, wal, 'bar', (123458, 3.0))
+    wal.sync()
+    self.assertEqual([1, 2, 3], wal.existing_segments())
+
+    cache, wal = self._start()
+    self.assertEqual([(123456, 1.0)], cache.get_datapoints('foo'))
+
+  def test_segments_removed_once_backlog_written(self):
+    self._settings_patch.values.update({'CACHE_WAL_MAX_SEGMENT_SIZE': 1, 'MAX_CREATE_BACKLOG': 100})
+    self._settings_patch.start()
+    cache, wal = self._start()
+    self._feed(cache, wal, 'foo', (123456, 1.0))
+    wal.sync()
+    self.backlog.add('foo', cache.pop('foo'))
+    self.backlog.pop()
+    wal.sync()
+    self.assertEqual([1, 2], wal.existing_segments())
+
+    self.assertEqual([], self.backlog.finish('foo'))
+    wal.sync()
+    self.assertEqual([2], wal.existing_segments())
+
+  def test_close_includes_backlog(self):
+    self._settings_patch.values['MAX_CREATE_BACKLOG'] = 100
+    self._settings_patch.start()
+    cache, wal = self._start()
+    self._feed(cache, wal, 'foo', (123456, 1.0))
+    self.backlog.add('foo', cache.pop('foo'))
+    wal.close(cache, self.backlog)
+    self.assertEqual(0, len(self.backlog))
+
+    cache, wal = self._start()
+    self.assertEqual([(123456, 1.0)], cache.get_datapoints('foo'))
+
+  def test_recover_ignores_truncated_record(self):
+    cache, wal = self._start()
+    self._feed(cache, wal, 'foo', (123456, 1.0))
+    wal.sync()
+    fh = open(wal.segment_path(wal.segment), 'ab')
+    fh.write('\x00\x03')
+    fh.close()
+
+    cache, wal = self._start()
+    self.assertEqual([(123456, 1.0)], cache.get_datapoints('foo'))
@@ -0,0 +1,78 @@
+import socket
+from unittest import TestCase, skipIf
+from mock import Mock, patch
+
+from carbon.util import pickle
+from carbon.workers import RECORDS_FD, RECORDS_LENGTH, SO_REUSEPORT, ReceiverSupervisorService, \
+    ReusePortTCPPort, ReusePortUDPPort, WorkerProcessProtocol
+
+
+def records_frame(records):
+  data = pickle.dumps(records, protocol=-1)
+  return RECORDS_LENGTH.pack(len(data)) + data
+
+
+class ReceiverSupervisorServiceTest(TestCase):
+  def setUp(self):
+    self.supervisor = ReceiverSupervisorService(2, [])
+
+  def test_take_records_adds_up_reports(self):
+    self.supervisor.recordsReceived(0, [('metricsReceived', 5, False), ('cpuUsage', 1.0, True)])
+    self.supervisor.recordsReceived(0, [('metricsReceived', 10, False), ('cpuUsage', 2.0, True)])
+    self.supervisor.recordsReceived(1, [('metricsReceived', 7, False), ('cpuUsage', 4.0, True)])
+    self.assertEqual({'metricsReceived': 22, 'cpuUsage': 6.0}, self.supervisor.takeRecords())
+    self.assertEqual({}, self.supervisor.takeRecords())
+
+  @patch('time.time')
+  def test_restart_delay_backs_off(self, time_mock):
+    time_mock.return_value = 1000.0
+    protocol = WorkerProcessProtocol(self.supervisor, 0)
+    delays = [self.supervisor.restartDelay(protocol) for _i in range(8)]
+    self.assertEqual([1, 2, 4, 8, 16, 32, 60, 60], delays)
+    time_mock.return_value += 60
+    self.assertEqual(1, self.supervisor.restartDelay(protocol))
+
+
+class WorkerProcessProtocolTest(TestCase):
+  def setUp(self):
+    self.supervisor = Mock()
+    self.protocol = WorkerProcessProtocol(self.supervisor, 1)
+
+  def test_records_split_across_reads(self):
+    data = records_frame([('foo', 1, False)]) + records_frame([('bar', 2, True)])
+    self.protocol.childDataReceived(RECORDS_FD, data[:3])
+    self.protocol.childDataReceived(RECORDS_FD, data[3:10])
+    self.assertFalse(self.supervisor.recordsReceived.called)
+    self.protocol.childDataReceived(RECORDS_FD, data[10:])
+    self.assertEqual([(1, [('foo', 1, False)]), (1, [('bar', 2, True)])],
+                     [args for args, _kwargs in self.supervisor.recordsReceived.call_args_list])
+    self.assertEqual('', self.protocol.records)
+
+  @patch('carbon.log.msg')
+  def test_output_is_logged_by_line(self, msg_mock):
+    self.protocol.childDataReceived(1, 'first line\nsecond')
+    self.protocol.childDataReceived(1, ' line\n')
+    self.assertEqual(['[worker 1] first line', '[worker 1] second line'],
+                     [args[0] for args, _kwargs in msg_mock.call_args_list])
+
+
+@skipIf(SO_REUSEPORT is None, "SO_REUSEPORT is not supported")
+class ReusePortTest(TestCase):
+  def _listen(self, port_class, port):
+    listener = port_class(port, Mock(), interface='127.0.0.1')
+    listener.startListening()
+    self.addCleanup(listener.stopListening)
+    return listener
+
+  def test_tcp_ports_can_be_shared(self):
+    first = self._listen(ReusePortTCPPort, 0)
+    port = first.getHost().port
+    second = self._listen(ReusePortTCPPort, port)
+    self.assertEqual(port, second.getHost().port)
+    self.assertTrue(second.socket.getsockopt(socket.SOL_SOCKET, SO_REUSEPORT))
+
+  def test_udp_ports_can_be_shared(self):
+    first = self._listen(ReusePortUDPPort, 0)
+    port = first.getHost().port
+    second = self._listen(ReusePortUDPPort, port)
+    self.assertEqual(port, second.getHost().port)
@@ -0,0 +1,173 @@
+from unittest import TestCase
+from mock import Mock, patch
+
+# carbon.writer loads the storage schemas at import
+with patch.dict('carbon.conf.settings', {'CONF_DIR': '/nonexistent'}):
+  with patch('carbon.storage.loadStorageSchemas', return_value=[]):
+    with patch('carbon.storage.loadAggregationSchemas', return_value=[]):
+      from carbon import writer
+      from carbon.writer import UpdateRateController, createBackloggedMetrics, \
+          createForever, optimalWriteOrder
+from carbon.backends import MemoryBackend
+from carbon.cache import _CreateBacklog, _MetricCache
+from carbon.util import TokenBucket
+
+
+class UpdateRateControllerTest(TestCase):
+  def setUp(self):
+    settings = {
+      'MAX_UPDATES_PER_SECOND': 100,
+      'MIN_UPDATES_PER_SECOND': 10,
+      'UPDATE_LATENCY_TARGET': 0.05,
+      'UPDATE_RATE_CACHE_SETPOINT': 1000,
+    }
+    self._settings_patch = patch.dict('carbon.conf.settings', settings)
+    self._settings_patch.start()
+    self.cache = Mock(size=0)
+    self.bucket = TokenBucket(100, 100)
+    self.controller = UpdateRateController(self.bucket, self.cache)
+
+  def tearDown(self):
+    self._settings_patch.stop()
+
+  def test_decreases_on_slow_updates(self):
+    for _i in range(100):
+      self.controller.observe(0.01)
+    for _i in range(5):
+      self.controller.observe(0.2)
+    self.controller.adjust()
+    self.assertAlmostEqual(70.0, self.controller.rate)
+    self.assertAlmostEqual(70.0, self.bucket.fill_rate)
+
+  def test_ignores_rare_outliers(self):
+    self.controller.rate = 50.0
+    for _i in range(200):
+      self.controller.observe(0.01)
+    self.controller.observe(0.2)
+    self.cache.size = 2000
+    self.controller.adjust()
+    self.assertAlmostEqual(55.0, self.controller.rate)
+
+  def test_increases_while_cache_grows(self):
+    self.controller.rate = 50.0
+    self.cache.size = 10
+    self.controller.adjust()
+    self.assertAlmostEqual(55.0, self.controller.rate)
+    self.controller.adjust()
+    self.assertAlmostEqual(55.0, self.controller.rate)
+
+  def test_stays_within_limits(self):
+    self.cache.size = 2000
+    self.controller.adjust()
+    self.assertAlmostEqual(100.0, self.controller.rate)
+    for _i in range(20):
+      self.controller.observe(1.0)
+      self.controller.adjust()
+    self.assertAlmostEqual(10.0, self.controller.rate)
+
+
+class CreateBacklogHandoffTest(TestCase):
+  def setUp(self):
+    self._settings_patch = patch.dict('carbon.conf.settings', {'MAX_CREATE_BACKLOG': 100})
+    self._settings_patch.start()
+    self.backend = MemoryBackend()
+    self.backlog = _CreateBacklog()
+    self.cache = _MetricCache()
+    patches = [
+      patch('carbon.state.storage_backend', self.backend),
+      patch('carbon.writer.CreateBacklog', self.backlog),
+      patch('carbon.writer.MetricCache', self.cache),
+      patch('carbon.writer.CREATE_BUCKET', None),
+      patch('carbon.writer.UPDATE_BUCKET', None),
+    ]
+    for p in patches:
+      p.start()
+      self.addCleanup(p.stop)
+
+  def tearDown(self):
+    self._settings_patch.stop()
+
+  def _create(self, metric):
+    self.backend.create(metric, [(60, 1440)])
+    return True
+
+  def test_new_metric_is_backlogged(self):
+    self.cache.store('foo', (120, 1.0))
+    self.assertEqual([], list(optimalWriteOrder(self.cache)))
+    self.assertEqual(('foo', [(120, 1.0)]), self.backlog.pop())
+
+  @patch('carbon.instrumentation.increment')
+  def test_dropped_datapoints_are_counted(self, increment_mock):
+    self._settings_patch.values['MAX_CREATE_BACKLOG'] = 2
+    self._settings_patch.start()
+    for timestamp in (120, 180, 240, 300):
+      self.cache.store('foo', (timestamp, 1.0))
+    list(optimalWriteOrder(self.cache))
+    increment_mock.assert_called_once_with('droppedCreates', 2)
+
+  def test_metric_being_created_is_not_queued_again(self):
+    self.backlog.add('foo', [(120, 1.0)])
+    self.backlog.pop()
+    self.cache.store('foo', (180, 2.0))
+    with patch.object(self.backend, 'exists') as exists_mock:
+      self.assertEqual([], list(optimalWriteOrder(self.cache)))
+      self.assertFalse(exists_mock.called)
+    self.assertEqual(0, len(self.backlog))
+    self.assertEqual([(180, 2.0)], self.backlog.finish('foo'))
+
+  def test_existing_metric_is_not_created_again(self):
+    self._create('foo')
+    self.backend.update_many('foo', [(120, 1.0)])
+    self.backlog.add('foo', [(180, 2.0)])
+    with patch('carbon.writer.createMetric') as create_mock:
+      createBackloggedMetrics()
+      self.assertFalse(create_mock.called)
+    self.assertEqual([(120, 1.0), (180, 2.0)], self.backend.fetch('foo'))
+
+  def test_datapoints_arriving_during_create_are_written(self):
+    def create(metric):
+      # A writer thread drains more datapoints while the file is created
+      self.cache.store(metric, (180, 2.0))
+      list(optimalWriteOrder(self.cache))
+      return self._create(metric)
+
+    self.backlog.add('foo', [(120, 1.0)])
+    with patch('carbon.writer.createMetric', side_effect=create):
+      createBackloggedMetrics()
+    self.assertEqual([(120, 1.0), (180, 2.0)], self.backend.fetch('foo'))
+    self.assertFalse('foo' in self.backlog)
+    self.assertEqual(0, self.cache.size)
+
+  def test_failed_create_requeues_late_datapoints(self):
+    def create(metric):
+      self.backlog.merge(metric, [(180, 2.0)])
+      return False
+
+    self.backlog.add('foo', [(120, 1.0)])
+    with patch('carbon.writer.createMetric', side_effect=create):
+      createBackloggedMetrics()
+    self.assertFalse('foo' in self.backlog)
+    self.assertEqual([(180, 2.0)], self.cache.get_datapoints('foo'))
+
+  def test_create_thread_drains_backlog_at_shutdown(self):
+    self.backlog.add('foo', [(120, 1.0)])
+    with patch('carbon.writer.reactor', Mock(running=False)):
+      with patch('carbon.writer.createMetric', side_effect=self._create):
+        createForever()
+    self.assertEqual([(120, 1.0)], self.backend.fetch('foo'))
+    self.assertEqual(0, len(self.backlog))
+
+  def test_create_thread_waits_for_writers_at_shutdown(self):
+    def sleep(seconds):
+      # The last writer hands a metric over just before it stops
+      if writer.writersRunning:
+        self.backlog.add('foo', [(120, 1.0)])
+        writer.writersRunning = 0
+
+    with patch('carbon.writer.reactor', Mock(running=False)):
+      with patch('carbon.writer.writersRunning', 1):
+        with patch('carbon.writer.createMetric', side_effect=self._create):
+          with patch('time.sleep', side_effect=sleep):
+            createForever()
+    self.assertEqual([(120, 1.0)], self.backend.fetch('foo'))
+    self.assertEqual(0, len(self.backlog))
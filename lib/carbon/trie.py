@@ -0,0 +1,117 @@
+"""Copyright 2009 Chris Davis
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+
+import re
+import threading
+from fnmatch import fnmatchcase
+
+
+BRACES = re.compile(r'\{([^{}]*)\}')
+GLOB_CHARS = set('*?[')
+
+
+def expand_braces(pattern):
+  """Expands each {a,b} alternation in pattern, returning the list of
+  resulting patterns"""
+  match = BRACES.search(pattern)
+  if not match:
+    return [pattern]
+  prefix, suffix = pattern[:match.start()], pattern[match.end():]
+  expanded = []
+  for alternative in match.group(1).split(','):
+    expanded.extend(expand_braces(prefix + alternative + suffix))
+  return expanded
+
+
+class _Node(object):
+  __slots__ = ('children', 'is_leaf')
+
+  def __init__(self):
+    self.children = {}
+    self.is_leaf = False
+
+
+class MetricTrie(object):
+  """The names of the cached metrics, split into their dotted components. It
+  watches the cache shards to stay current as entries are created and popped,
+  and resolves Graphite path patterns by walking only the branches a pattern
+  can match."""
+  def __init__(self, metrics=()):
+    self.lock = threading.Lock()
+    self.root = _Node()
+    for metric in metrics:
+      self.add(metric)
+
+  def add(self, metric):
+    with self.lock:
+      node = self.root
+      for component in metric.split('.'):
+        child = node.children.get(component)
+        if child is None:
+          child = node.children[component] = _Node()
+        node = child
+      node.is_leaf = True
+
+  def remove(self, metric):
+    with self.lock:
+      path = [self.root]
+      components = metric.split('.')
+      for component in components:
+        node = path[-1].children.get(component)
+        if node is None:
+          return
+        path.append(node)
+      path[-1].is_leaf = False
+
+      for i in range(len(components), 0, -1):  # prune empty branches, deepest first
+        node = path[i]
+        if node.is_leaf or node.children:
+          break
+        del path[i - 1].children[components[i - 1]]
+
+  def find(self, pattern):
+    """Returns a (path, is_leaf) pair for every node matching pattern. A path
+    that is both a metric and the parent of others is reported as a leaf."""
+    patterns = [expand_braces(component) for component in pattern.split('.')]
+    matches = []
+    with self.lock:
+      self._find(self.root, patterns, 0, [], matches)
+    return matches
+
+  def _find(self, node, patterns, depth, prefix, matches):
+    if depth == len(patterns):
+      matches.append(('.'.join(prefix), node.is_leaf))
+      return
+
+    children = node.children
+    seen = set()
+    for alternative in patterns[depth]:
+      if GLOB_CHARS.isdisjoint(alternative):
+        names = [alternative] if alternative in children else []
+      else:
+        names = [name for name in children if fnmatchcase(name, alternative)]
+      for name in names:
+        if name in seen:
+          continue
+        seen.add(name)
+        prefix.append(name)
+        self._find(children[name], patterns, depth + 1, prefix, matches)
+        prefix.pop()
+
+  def metric_stored(self, metric, count):
+    if count == 1:
+      self.add(metric)
+
+  def metric_popped(self, metric):
+    self.remove(metric)
@@ -15,6 +15,8 @@ except ImportError:
   import pickle
   USING_CPICKLE = False
 
+from itertools import izip
+from struct import Struct, calcsize, pack, unpack_from, error as StructError
 from time import sleep, time
 from twisted.python.util import initgroups
 from twisted.scripts.twistd import runApp
@@ -159,6 +161,18 @@ else:
       return cls(StringIO(pickle_string)).load()
  
 
+def intern_name(name):
+  """Returns the canonical copy of a metric name, so that the cache, the
+  aggregation buffers and the relay queues share one string per metric instead
+  of holding the copy made for every parsed datapoint. Interned strings are
+  released once nothing else refers to them, so names no longer cached,
+  buffered or queued drop out of the table on their own."""
+  try:
+    return intern(name)
+  except TypeError:  # unicode names can't be interned
+    return name
+
+
 def get_unpickler(insecure=False):
   if insecure:
     return pickle
@@ -166,6 +180,62 @@ def get_unpickler(insecure=False):
     return SafeUnpickler
 
 
+# The binary protocol sends the same length-prefixed messages as the pickle
+# protocol. Each holds a uint32 count of metric names, that many names, each a
+# uint16 length followed by the name, and then (uint32 index of the name,
+# int64 timestamp, float64 value) records until the end of the message, all in
+# network byte order.
+BINARY_NAME_COUNT = Struct('!I')
+BINARY_NAME_LENGTH = Struct('!H')
+BINARY_RECORD = 'Iqd'
+BINARY_RECORD_SIZE = calcsize('!' + BINARY_RECORD)
+
+
+def encode_binary(datapoints):
+  """Returns a binary protocol message for a list of (metric, datapoint) pairs"""
+  indexes = {}
+  parts = [None]
+  records = []
+  for metric, (timestamp, value) in datapoints:
+    index = indexes.get(metric)
+    if index is None:
+      index = indexes[metric] = len(indexes)
+      if isinstance(metric, unicode):
+        metric = metric.encode('utf-8')
+      parts.append(BINARY_NAME_LENGTH.pack(len(metric)))
+      parts.append(metric)
+    records.extend((index, int(timestamp), value))
+  parts[0] = BINARY_NAME_COUNT.pack(len(indexes))
+  parts.append(pack('!' + BINARY_RECORD * len(datapoints), *records))
+  return ''.join(parts)
+
+
+def decode_binary(data):
+  """Returns the list of (metric, datapoint) pairs in a binary protocol
+  message, raising ValueError if it is malformed. The records are unpacked in
+  place with a single call."""
+  try:
+    (count,) = BINARY_NAME_COUNT.unpack_from(data)
+    offset = BINARY_NAME_COUNT.size
+    names = []
+    for _i in xrange(count):
+      (length,) = BINARY_NAME_LENGTH.unpack_from(data, offset)
+      offset += BINARY_NAME_LENGTH.size
+      if offset + length > len(data):
+        raise ValueError("name extends past the end of the message")
+      names.append(intern_name(data[offset:offset + length]))
+      offset += length
+
+    records, remainder = divmod(len(data) - offset, BINARY_RECORD_SIZE)
+    if remainder:
+      raise ValueError("message ends with a partial record")
+    fields = iter(unpack_from('!' + BINARY_RECORD * records, data, offset))
+    return [(names[index], (timestamp, value))
+            for (index, timestamp, value) in izip(fields, fields, fields)]
+  except (IndexError, StructError), e:
+    raise ValueError("invalid binary message: %s" % e)
+
+
 class TokenBucket(object):
   '''This is a basic tokenbucket rate limiter implementation for use in
   enforcing various configurable rate limits'''
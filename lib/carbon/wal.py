@@ -0,0 +1,289 @@
+"""Copyright 2009 Chris Davis
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+
+import os
+import re
+import struct
+import threading
+from os.path import exists, join
+
+from twisted.application.service import Service
+from twisted.internet.task import LoopingCall
+
+from carbon.conf import settings
+from carbon import log
+
+
+# A journal record is a datapoint followed by its metric name
+RECORD = struct.Struct('!Hqd')  # name length, timestamp, value
+# A snapshot holds each metric once, followed by all of its datapoints
+SNAPSHOT_HEADER = struct.Struct('!HI')  # name length, datapoint count
+POINT = struct.Struct('!qd')  # timestamp, value
+
+
+def readJournal(path):
+  """Generates the (metric, datapoint) records of a journal segment, stopping
+  at a truncated trailing record"""
+  fh = open(path, 'rb')
+  try:
+    data = fh.read()
+  finally:
+    fh.close()
+
+  offset = 0
+  end = len(data)
+  while offset + RECORD.size <= end:
+    name_length, timestamp, value = RECORD.unpack_from(data, offset)
+    offset += RECORD.size
+    if offset + name_length > end:
+      break
+    yield (data[offset:offset + name_length], (timestamp, value))
+    offset += name_length
+
+
+def readSnapshot(path):
+  """Generates the (metric, datapoint) records of a snapshot file, stopping at
+  a truncated trailing entry"""
+  fh = open(path, 'rb')
+  try:
+    data = fh.read()
+  finally:
+    fh.close()
+
+  offset = 0
+  end = len(data)
+  while offset + SNAPSHOT_HEADER.size <= end:
+    name_length, count = SNAPSHOT_HEADER.unpack_from(data, offset)
+    offset += SNAPSHOT_HEADER.size
+    if offset + name_length + count * POINT.size > end:
+      break
+    metric = data[offset:offset + name_length]
+    offset += name_length
+    for _i in xrange(count):
+      yield (metric, POINT.unpack_from(data, offset))
+      offset += POINT.size
+
+
+def writeSnapshotEntry(fh, metric, datapoints):
+  """Writes a metric and its datapoints to a snapshot file, returning the
+  number of datapoints written"""
+  fh.write(SNAPSHOT_HEADER.pack(len(metric), len(datapoints)) + metric)
+  fh.write(''.join([POINT.pack(timestamp, value) for (timestamp, value) in datapoints]))
+  return len(datapoints)
+
+
+class WriteAheadLog(object):
+  """An append-only journal of the datapoints fed to the cache, split into
+  numbered segment files. Every cache entry is tagged with the segment that
+  was current when the entry was created; a segment file is deleted once no
+  live cache entry is older than it, since everything it holds has by then
+  been popped by a writer. A metric the writer hands on to the create
+  backlog keeps every file then on disk until its datapoints have been
+  written. At shutdown the remaining cache contents are written to a snapshot
+  instead, so that the writers need not drain them."""
+  def __init__(self, directory, prefix):
+    self.directory = directory
+    self.prefix = prefix
+    self.segment_pattern = re.compile(r'^%s\.wal\.(\d+)$' % re.escape(prefix))
+    self.snapshot_path = join(directory, prefix + '.snapshot')
+    self.lock = threading.Lock()
+    self.tags = {}  # { metric : segment its cache entry was created in }
+    self.backlog_tags = {}  # { metric : oldest segment when it was backlogged }
+    self.refs = {}  # { segment : number of live cache entries tagged with it }
+    self.segment = 0
+    self.closed_segments = []
+    self.snapshot_segment = None
+    self.fh = None
+
+  def segment_path(self, segment):
+    return join(self.directory, '%s.wal.%d' % (self.prefix, segment))
+
+  def existing_segments(self):
+    segments = []
+    for filename in os.listdir(self.directory):
+      match = self.segment_pattern.match(filename)
+      if match:
+        segments.append(int(match.group(1)))
+    return sorted(segments)
+
+  def recover(self, cache):
+    """Replays any snapshot and journal segments left by the previous run into
+    cache, then starts a new segment. The recovered files are kept until the
+    entries they restored have all been popped."""
+    if not exists(self.directory):
+      os.makedirs(self.directory)
+
+    self.closed_segments = self.existing_segments()
+    newest = self.closed_segments[-1] if self.closed_segments else 0
+    # Tag the restored entries with the oldest recovered file, which keeps
+    # every one of them until all those entries have been popped
+    if self.closed_segments:
+      self.segment = self.closed_segments[0]
+
+    restored = 0
+    if exists(self.snapshot_path):
+      self.snapshot_segment = self.segment
+      for metric, datapoint in readSnapshot(self.snapshot_path):
+        cache.store(metric, datapoint, force=True)
+        restored += 1
+    for segment in self.closed_segments:
+      for metric, datapoint in readJournal(self.segment_path(segment)):
+        cache.store(metric, datapoint, force=True)
+        restored += 1
+    if restored:
+      log.cache("restored %d datapoints from %s" % (restored, self.directory))
+
+    self.open_segment(newest + 1)
+
+  def open_segment(self, segment):
+    with self.lock:
+      self.segment = segment
+    self.fh = open(self.segment_path(segment), 'ab', 2 ** 20)
+
+  def write(self, metric, datapoint):
+    if self.fh is None:
+      return
+    timestamp, value = datapoint
+    self.fh.write(RECORD.pack(len(metric), int(timestamp), value) + metric)
+
+  def sync(self):
+    """Flushes and fsyncs the current segment, starts a new one if it has grown
+    past CACHE_WAL_MAX_SEGMENT_SIZE and removes files no longer needed"""
+    if self.fh is None:
+      return
+    self.fh.flush()
+    os.fsync(self.fh.fileno())
+
+    if self.fh.tell() >= settings.CACHE_WAL_MAX_SEGMENT_SIZE:
+      self.fh.close()
+      self.closed_segments.append(self.segment)
+      self.open_segment(self.segment + 1)
+
+    removed = []
+    with self.lock:
+      oldest_live = min(self.refs) if self.refs else self.segment + 1
+      while self.closed_segments and self.closed_segments[0] < oldest_live:
+        removed.append(self.segment_path(self.closed_segments.pop(0)))
+      if self.snapshot_segment is not None and self.snapshot_segment < oldest_live:
+        removed.append(self.snapshot_path)
+        self.snapshot_segment = None
+
+    for path in removed:
+      os.unlink(path)
+
+  def close(self, cache, backlog=None):
+    """Moves the cache contents, and the metrics still queued in the create
+    backlog if one is given, into a fresh snapshot, then removes the journal,
+    which the snapshot now supersedes"""
+    if self.fh is None:
+      return
+    self.fh.close()
+    self.fh = None
+
+    tmp_path = self.snapshot_path + '.tmp'
+    fh = open(tmp_path, 'wb', 2 ** 20)
+    count = 0
+    for shard in cache.shards:
+      for metric in shard.keys():
+        try:
+          datapoints = shard.pop(metric)
+        except KeyError:  # a writer got to it first
+          continue
+        count += writeSnapshotEntry(fh, metric, datapoints)
+    if backlog is not None:
+      for metric, datapoints in backlog.drain():
+        count += writeSnapshotEntry(fh, metric, datapoints)
+    fh.flush()
+    os.fsync(fh.fileno())
+    fh.close()
+    # Anything restored from an older snapshot was either still cached, and so
+    # is in this one, or has been written by now
+    os.rename(tmp_path, self.snapshot_path)
+    log.cache("wrote %d cached datapoints to %s" % (count, self.snapshot_path))
+
+    for segment in self.closed_segments + [self.segment]:
+      path = self.segment_path(segment)
+      if exists(path):
+        os.unlink(path)
+    self.closed_segments = []
+    self.snapshot_segment = None
+
+  def metric_stored(self, metric, count):
+    if count != 1:
+      return
+    with self.lock:
+      segment = self.segment
+      self.tags[metric] = segment
+      self.refs[segment] = self.refs.get(segment, 0) + 1
+
+  def metric_popped(self, metric):
+    with self.lock:
+      self._release(self.tags.pop(metric, None))
+
+  def metric_deferred(self, metric):
+    """Keeps every file still on disk until metric_released(metric), since the
+    datapoints of a metric handed from the cache to the create backlog may be
+    in any of them, and are only written once the metric has been created"""
+    with self.lock:
+      segment = self._oldest_segment()
+      self.backlog_tags[metric] = segment
+      self.refs[segment] = self.refs.get(segment, 0) + 1
+
+  def metric_released(self, metric):
+    with self.lock:
+      self._release(self.backlog_tags.pop(metric, None))
+
+  def metric_restored(self, metric):
+    """Moves the tag of the cache entry of metric back to the oldest file still
+    on disk, since datapoints put back into the cache after a failed write may
+    only be journaled in any of them"""
+    with self.lock:
+      segment = self.tags.get(metric)
+      oldest = self._oldest_segment()
+      if segment is None or segment <= oldest:
+        return
+      self._release(segment)
+      self.tags[metric] = oldest
+      self.refs[oldest] = self.refs.get(oldest, 0) + 1
+
+  def _oldest_segment(self):
+    segments = self.closed_segments[:1] + [self.segment]
+    if self.snapshot_segment is not None:
+      segments.append(self.snapshot_segment)
+    return min(segments)
+
+  def _release(self, segment):
+    if segment is None:
+      return
+    self.refs[segment] -= 1
+    if not self.refs[segment]:
+      del self.refs[segment]
+
+
+class WriteAheadLogService(Service):
+  def __init__(self, wal, cache, backlog=None):
+    self.wal = wal
+    self.cache = cache
+    self.backlog = backlog
+    self.sync_task = LoopingCall(wal.sync)
+
+  def startService(self):
+    self.wal.recover(self.cache)
+    self.sync_task.start(settings.CACHE_WAL_SYNC_INTERVAL, False)
+    Service.startService(self)
+
+  def stopService(self):
+    self.sync_task.stop()
+    self.wal.close(self.cache, self.backlog)
+    Service.stopService(self)
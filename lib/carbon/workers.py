@@ -0,0 +1,257 @@
+"""Copyright 2009 Chris Davis
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+   http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License."""
+
+import os
+import sys
+import time
+import socket
+from struct import Struct
+
+from zope.interface import implements
+from twisted.application.service import Service
+from twisted.internet import main, reactor, tcp, udp
+from twisted.internet.defer import Deferred, DeferredList
+from twisted.internet.error import ProcessExitedAlready
+from twisted.internet.interfaces import IReadDescriptor
+from twisted.internet.protocol import ProcessProtocol
+from carbon.conf import RECEIVER_WORKER_ENV
+from carbon.exceptions import CarbonConfigException
+from carbon.util import pickle
+from carbon import log, state
+
+
+if hasattr(socket, 'SO_REUSEPORT'):
+  SO_REUSEPORT = socket.SO_REUSEPORT
+elif sys.platform.startswith('linux'):
+  SO_REUSEPORT = 15  # Python 2's socket module does not define it
+else:
+  SO_REUSEPORT = None
+
+# Worker processes report their instrumentation records to their parent as
+# length-prefixed pickles on this descriptor
+RECORDS_FD = 3
+RECORDS_LENGTH = Struct('!I')
+
+# Seconds to wait for workers to shut down before they are killed
+WORKER_SHUTDOWN_TIMEOUT = 60
+
+# Seconds to wait before restarting a worker that exited. The delay doubles
+# each time a worker exits again before having run for MAX_RESTART_DELAY.
+MIN_RESTART_DELAY = 1
+MAX_RESTART_DELAY = 60
+
+
+def check_reuse_port():
+  if SO_REUSEPORT is None:
+    raise CarbonConfigException("RECEIVER_PROCESSES requires SO_REUSEPORT, "
+                                "which is not supported on this platform")
+
+
+class ReusePortTCPPort(tcp.Port):
+  def createInternetSocket(self):
+    skt = tcp.Port.createInternetSocket(self)
+    skt.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    return skt
+
+
+class ReusePortUDPPort(udp.Port):
+  def createInternetSocket(self):
+    skt = udp.Port.createInternetSocket(self)
+    skt.setsockopt(socket.SOL_SOCKET, SO_REUSEPORT, 1)
+    return skt
+
+
+class ReusePortServer(Service):
+  """Like TCPServer and UDPServer, but binds its port with SO_REUSEPORT so
+  that every receiver worker process can listen on it. The kernel spreads new
+  connections (and UDP senders) across the processes."""
+  def __init__(self, port_class, *args, **kwargs):
+    self.port_class = port_class
+    self.args = args
+    self.kwargs = kwargs
+    self._port = None
+
+  def startService(self):
+    Service.startService(self)
+    self._port = self.port_class(*self.args, reactor=reactor, **self.kwargs)
+    self._port.startListening()
+
+  def stopService(self):
+    Service.stopService(self)
+    if self._port is not None:
+      port, self._port = self._port, None
+      return port.stopListening()
+
+
+def send_records(records):
+  """Sends a worker's list of (metric, value, is_gauge) instrumentation
+  records to its parent"""
+  data = pickle.dumps(records, protocol=-1)
+  data = RECORDS_LENGTH.pack(len(data)) + data
+  while data:
+    data = data[os.write(RECORDS_FD, data):]
+
+
+class ParentWatcher(object):
+  """Stops a worker's reactor once its stdin, a pipe from its parent, is
+  closed, so that workers do not outlive their parent"""
+  implements(IReadDescriptor)
+
+  def fileno(self):
+    return 0
+
+  def doRead(self):
+    if not os.read(0, 4096):
+      return main.CONNECTION_DONE
+
+  def connectionLost(self, reason):
+    reactor.removeReader(self)
+    if reactor.running:
+      log.msg("Parent process exited, shutting down")
+      reactor.stop()
+
+  def logPrefix(self):
+    return 'ParentWatcher'
+
+
+class ReceiverWorkerService(Service):
+  def startService(self):
+    Service.startService(self)
+    reactor.addReader(ParentWatcher())
+
+
+class WorkerProcessProtocol(ProcessProtocol):
+  def __init__(self, supervisor, index):
+    self.supervisor = supervisor
+    self.index = index
+    self.output = {1: '', 2: ''}
+    self.records = ''
+    self.started = time.time()
+    self.ended = Deferred()
+
+  def childDataReceived(self, fd, data):
+    if fd == RECORDS_FD:
+      self.records += data
+      while len(self.records) >= RECORDS_LENGTH.size:
+        (length,) = RECORDS_LENGTH.unpack_from(self.records)
+        end = RECORDS_LENGTH.size + length
+        if len(self.records) < end:
+          break
+        records = pickle.loads(self.records[RECORDS_LENGTH.size:end])
+        self.records = self.records[end:]
+        self.supervisor.recordsReceived(self.index, records)
+    else:  # Workers run in the foreground and log to stdout
+      lines = (self.output[fd] + data).split('\n')
+      self.output[fd] = lines.pop()
+      for line in lines:
+        log.msg("[worker %d] %s" % (self.index, line))
+
+  def processEnded(self, reason):
+    self.supervisor.workerEnded(self, reason)
+    self.ended.callback(None)
+
+
+class ReceiverSupervisorService(Service):
+  """Runs count copies of this carbon daemon as worker processes, each with
+  its own receivers bound with SO_REUSEPORT and its own pipeline. Workers are
+  restarted when they exit, and their instrumentation is recorded by this
+  process, added up under its own instance."""
+  def __init__(self, count, argv):
+    self.count = count
+    self.argv = argv
+    self.workers = {}  # { index : WorkerProcessProtocol }
+    self.restart_delays = {}  # { index : seconds }
+    self.records = {}  # { index : { metric : value } }, since takeRecords()
+
+  def startService(self):
+    Service.startService(self)
+    state.receiver_supervisor = self
+    for index in range(self.count):
+      self.spawn(index)
+
+  def spawn(self, index):
+    if not self.running:
+      return
+    protocol = WorkerProcessProtocol(self, index)
+    env = dict(os.environ)
+    env[RECEIVER_WORKER_ENV] = str(index)
+    reactor.spawnProcess(protocol, sys.executable, [sys.executable] + self.argv, env=env,
+                         childFDs={0: 'w', 1: 'r', 2: 'r', RECORDS_FD: 'r'})
+    self.workers[index] = protocol
+    log.msg("Started receiver worker %d with pid %d" % (index, protocol.transport.pid))
+
+  def workerEnded(self, protocol, reason):
+    if self.workers.get(protocol.index) is protocol:
+      del self.workers[protocol.index]
+    if self.running:
+      delay = self.restartDelay(protocol)
+      log.msg("Receiver worker %d exited (%s), restarting it in %d seconds" %
+              (protocol.index, reason.value, delay))
+      reactor.callLater(delay, self.spawn, protocol.index)
+
+  def restartDelay(self, protocol):
+    """Returns how long to wait before restarting the worker of protocol,
+    backing off while it keeps exiting soon after being started"""
+    if time.time() - protocol.started >= MAX_RESTART_DELAY:
+      delay = MIN_RESTART_DELAY
+    else:
+      delay = self.restart_delays.get(protocol.index, MIN_RESTART_DELAY)
+    self.restart_delays[protocol.index] = min(delay * 2, MAX_RESTART_DELAY)
+    return delay
+
+  def recordsReceived(self, index, records):
+    """Adds up the counts a worker reports until takeRecords() is called,
+    keeping only the latest value of its gauges, since the worker may report
+    more than once in the meantime"""
+    totals = self.records.setdefault(index, {})
+    for metric, value, is_gauge in records:
+      if is_gauge:
+        totals[metric] = value
+      else:
+        totals[metric] = totals.get(metric, 0) + value
+
+  def takeRecords(self):
+    """Returns the records of every worker since the last call, summed by
+    metric"""
+    totals = {}
+    for records in self.records.itervalues():
+      for metric, value in records.iteritems():
+        totals[metric] = totals.get(metric, 0) + value
+    self.records.clear()
+    return totals
+
+  def killWorkers(self):
+    for protocol in self.workers.values():
+      try:
+        protocol.transport.signalProcess('KILL')
+      except ProcessExitedAlready:
+        pass
+
+  def stopService(self):
+    Service.stopService(self)
+    ended = []
+    for protocol in self.workers.values():
+      try:
+        protocol.transport.signalProcess('TERM')
+      except ProcessExitedAlready:
+        pass
+      ended.append(protocol.ended)
+
+    kill_call = reactor.callLater(WORKER_SHUTDOWN_TIMEOUT, self.killWorkers)
+
+    def cancel_kill(result):
+      if kill_call.active():
+        kill_call.cancel()
+      return result
+    return DeferredList(ended).addBoth(cancel_kill)
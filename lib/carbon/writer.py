@@ -12,17 +12,16 @@ WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 See the License for the specific language governing permissions and
 limitations under the License."""
 
-import os
 import time
-from os.path import exists, dirname
+import threading
+from errno import ENOENT
 
-import whisper
 from carbon import state
-from carbon.cache import MetricCache
-from carbon.storage import getFilesystemPath, loadStorageSchemas,\
-    loadAggregationSchemas
+from carbon.cache import MetricCache, CreateBacklog
+from carbon.storage import loadStorageSchemas, loadAggregationSchemas,\
+    SchemaMatcher
 from carbon.conf import settings
-from carbon import log, events, instrumentation
+from carbon import log, instrumentation
 from carbon.util import TokenBucket
 
 from twisted.internet import reactor
@@ -35,9 +34,8 @@ except ImportError:
     log.debug("Couldn't import signal module")
 
 
-SCHEMAS = loadStorageSchemas()
-AGGREGATION_SCHEMAS = loadAggregationSchemas()
-CACHE_SIZE_LOW_WATERMARK = settings.MAX_CACHE_SIZE * 0.95
+SCHEMAS = SchemaMatcher(loadStorageSchemas(), settings.SCHEMA_CACHE_SIZE)
+AGGREGATION_SCHEMAS = SchemaMatcher(loadAggregationSchemas(), settings.SCHEMA_CACHE_SIZE)
 
 
 # Inititalize token buckets so that we can enforce rate limits on creates and
@@ -55,116 +53,233 @@ if settings.MAX_UPDATES_PER_SECOND != float('inf'):
   UPDATE_BUCKET = TokenBucket(capacity, fill_rate)
 
 
-def optimalWriteOrder():
-  """Generates metrics with the most cached values first and applies a soft
-  rate limit on new metrics"""
-  while MetricCache:
-    (metric, datapoints) = MetricCache.drain_metric()
-    if state.cacheTooFull and MetricCache.size < CACHE_SIZE_LOW_WATERMARK:
-      events.cacheSpaceAvailable()
+class UpdateRateController(object):
+  """Adjusts the rate of a token bucket limiting updates, additive increase
+  and multiplicative decrease style. The rate is cut back whenever the 99th
+  percentile of recent update times exceeds UPDATE_LATENCY_TARGET, since the
+  disk is then falling behind. Otherwise it is raised step by step while the
+  cache is growing or holds more than UPDATE_RATE_CACHE_SETPOINT datapoints.
+  It stays between MIN_UPDATES_PER_SECOND and MAX_UPDATES_PER_SECOND."""
+  INCREASE_STEP = 0.05  # of MAX_UPDATES_PER_SECOND
+  DECREASE_FACTOR = 0.7
+  INTERVAL = 5
+
+  def __init__(self, bucket, cache=MetricCache):
+    self.bucket = bucket
+    self.cache = cache
+    self.rate = bucket.fill_rate
+    self.update_times = []
+    self.last_size = cache.size
+    self.task = LoopingCall(self.adjust)
+
+  def observe(self, updateTime):
+    self.update_times.append(updateTime)
+
+  def adjust(self):
+    update_times, self.update_times = self.update_times, []
+    size = self.cache.size
+    growth = size - self.last_size
+    self.last_size = size
+
+    max_rate = float(settings.MAX_UPDATES_PER_SECOND)
+    min_rate = min(float(settings.MIN_UPDATES_PER_SECOND), max_rate)
+    rate = self.rate
+    if update_times:
+      update_times.sort()
+      p99 = update_times[int(0.99 * (len(update_times) - 1))]
+    else:
+      p99 = 0.0
+    if p99 > settings.UPDATE_LATENCY_TARGET:
+      rate *= self.DECREASE_FACTOR
+    elif growth > 0 or size > settings.UPDATE_RATE_CACHE_SETPOINT:
+      rate += max_rate * self.INCREASE_STEP
+    rate = max(min_rate, min(max_rate, rate))
+
+    if rate != self.rate:
+      log.debug("update rate %.1f -> %.1f (p99 update time %.4fs, cache size %d)" %
+                (self.rate, rate, p99, size))
+      self.rate = rate
+      self.bucket.setCapacityAndFillRate(rate, rate)
+    instrumentation.append('updateRates', rate)
+
+  def start(self):
+    self.task.start(self.INTERVAL, False)
+
+  def stop(self):
+    if self.task.running:
+      self.task.stop()
+
+
+UPDATE_RATE_CONTROLLER = None
+if UPDATE_BUCKET and settings.ENABLE_UPDATE_RATE_CONTROL:
+  UPDATE_RATE_CONTROLLER = UpdateRateController(UPDATE_BUCKET)
+
+
+def optimalWriteOrder(cache=MetricCache):
+  """Generates metrics with the most cached values first. Metrics not yet in
+  the storage backend are handed to the CreateBacklog instead, for the create
+  threads to create them and write their datapoints."""
+  backend = state.storage_backend
+  while cache:
+    (metric, datapoints) = cache.drain_metric()
+
+    # Keep the datapoints with any still waiting for the metric's creation
+    dropped = CreateBacklog.merge(metric, datapoints)
+    if dropped is None:
+      if backend.exists(metric):
+        yield (metric, datapoints)
+        continue
+      dropped = CreateBacklog.add(metric, datapoints)
+    if dropped:
+      instrumentation.increment('droppedCreates', dropped)
+
+
+def createMetric(metric):
+  "Create a new metric in the storage backend, returning whether it succeeded"
+  archiveConfig = None
+  xFilesFactor, aggregationMethod = None, None
+
+  schema = SCHEMAS.match(metric)
+  if schema:
+    log.creates('new metric %s matched schema %s' % (metric, schema.name))
+    archiveConfig = [archive.getTuple() for archive in schema.archives]
+
+  schema = AGGREGATION_SCHEMAS.match(metric)
+  if schema:
+    log.creates('new metric %s matched aggregation schema %s' % (metric, schema.name))
+    xFilesFactor, aggregationMethod = schema.archives
+
+  if not archiveConfig:
+    raise Exception("No storage schema matched the metric '%s', check your "
+                    "storage-schemas.conf file." % metric)
 
-    dbFilePath = getFilesystemPath(metric)
-    dbFileExists = exists(dbFilePath)
-
-    if not dbFileExists and CREATE_BUCKET:
-      # If our tokenbucket has enough tokens available to create a new metric
-      # file then yield the metric data to complete that operation. Otherwise
-      # we'll just drop the metric on the ground and move on to the next
-      # metric.
-      # XXX This behavior should probably be configurable to no tdrop metrics
-      # when rate limitng unless our cache is too big or some other legit
-      # reason.
-      if CREATE_BUCKET.drain(1):
-        yield (metric, datapoints, dbFilePath, dbFileExists)
-      continue
-
-    yield (metric, datapoints, dbFilePath, dbFileExists)
+  try:
+      t1 = time.time()
+      state.storage_backend.create(metric, archiveConfig, xFilesFactor, aggregationMethod)
+      instrumentation.append('createTimes', time.time() - t1)
+      instrumentation.increment('creates')
+  except:
+      log.err("Error creating %s" % (metric))
+      return False
+  return True
+
+
+def writeDataPoints(metric, datapoints):
+  """Write datapoints of a metric that exists in the storage backend,
+  returning whether they were written"""
+  # If we've got a rate limit configured lets makes sure we enforce it
+  if UPDATE_BUCKET:
+    UPDATE_BUCKET.drain(1, blocking=True)
+  try:
+    t1 = time.time()
+    state.storage_backend.update_many(metric, datapoints)
+    updateTime = time.time() - t1
+  except (IOError, OSError), e:
+    if e.errno != ENOENT:
+      log.msg("Error writing %s" % (metric))
+      log.err()
+      instrumentation.increment('errors')
+      return False
+    # The metric was removed since we last saw it, so requeue the
+    # datapoints for it to be created again
+    log.msg("%s has disappeared, recreating it" % (metric))
+    MetricCache.restore(metric, datapoints)
+    return False
+  except Exception:
+    log.msg("Error writing %s" % (metric))
+    log.err()
+    instrumentation.increment('errors')
+    return False
+  else:
+    pointCount = len(datapoints)
+    instrumentation.increment('committedPoints', pointCount)
+    instrumentation.append('updateTimes', updateTime)
+    if UPDATE_RATE_CONTROLLER:
+      UPDATE_RATE_CONTROLLER.observe(updateTime)
+    if settings.LOG_UPDATES:
+      log.updates("wrote %d datapoints for %s in %.5f seconds" % (pointCount, metric, updateTime))
+    return True
+
+
+def writeCachedDataPoints(cache=MetricCache):
+  "Write datapoints until the given part of the MetricCache is completely empty"
+
+  while cache:
+    dataWritten = False
 
+    for (metric, datapoints) in optimalWriteOrder(cache):
+      dataWritten = True
+      writeDataPoints(metric, datapoints)
 
-def writeCachedDataPoints():
-  "Write datapoints until the MetricCache is completely empty"
+    # Avoid churning CPU when only new metrics are in the cache
+    if not dataWritten:
+      time.sleep(0.1)
 
-  while MetricCache:
-    dataWritten = False
 
-    for (metric, datapoints, dbFilePath, dbFileExists) in optimalWriteOrder():
-      dataWritten = True
+def createBackloggedMetrics():
+  """Create the metrics in the CreateBacklog until it is empty, applying the
+  soft rate limit on new metrics"""
+  while CreateBacklog:
+    if CREATE_BUCKET:
+      CREATE_BUCKET.drain(1, blocking=True)
+    (metric, datapoints) = CreateBacklog.pop()
+    if metric is None:
+      break
 
-      if not dbFileExists:
-        archiveConfig = None
-        xFilesFactor, aggregationMethod = None, None
-
-        for schema in SCHEMAS:
-          if schema.matches(metric):
-            log.creates('new metric %s matched schema %s' % (metric, schema.name))
-            archiveConfig = [archive.getTuple() for archive in schema.archives]
-            break
-
-        for schema in AGGREGATION_SCHEMAS:
-          if schema.matches(metric):
-            log.creates('new metric %s matched aggregation schema %s' % (metric, schema.name))
-            xFilesFactor, aggregationMethod = schema.archives
-            break
-
-        if not archiveConfig:
-          raise Exception("No storage schema matched the metric '%s', check your storage-schemas.conf file." % metric)
-
-        dbDir = dirname(dbFilePath)
-        try:
-            if not exists(dbDir):
-                os.makedirs(dbDir)
-        except OSError, e:
-            log.err("%s" % e)
-        log.creates("creating database file %s (archive=%s xff=%s agg=%s)" %
-                    (dbFilePath, archiveConfig, xFilesFactor, aggregationMethod))
-        try:
-            whisper.create(
-                dbFilePath,
-                archiveConfig,
-                xFilesFactor,
-                aggregationMethod,
-                settings.WHISPER_SPARSE_CREATE,
-                settings.WHISPER_FALLOCATE_CREATE)
-            instrumentation.increment('creates')
-        except:
-            log.err("Error creating %s" % (dbFilePath))
-            continue
-      # If we've got a rate limit configured lets makes sure we enforce it
-      if UPDATE_BUCKET:
-        UPDATE_BUCKET.drain(1, blocking=True)
+    try:
+      # The metric may have been created by an earlier entry after all, if
+      # datapoints drained while that one was being created were requeued
+      if state.storage_backend.exists(metric) or createMetric(metric):
+        # Datapoints drained while the metric was being created are written
+        # here too, so that none are left in the cache once the writer
+        # threads have stopped at shutdown
+        while datapoints and writeDataPoints(metric, datapoints):
+          datapoints = CreateBacklog.finish(metric)
+    finally:
+      # Otherwise they go back to the cache, for the metric to be retried
+      CreateBacklog.abort(metric, MetricCache.restore)
+
+
+# Writer threads still running, which may go on handing metrics over to the
+# create backlog after the reactor has stopped
+writersRunning = 0
+writersLock = threading.Lock()
+
+
+def writeForever(cache=MetricCache):
+  global writersRunning
+  with writersLock:
+    writersRunning += 1
+  try:
+    while reactor.running:
       try:
-        t1 = time.time()
-        whisper.update_many(dbFilePath, datapoints)
-        updateTime = time.time() - t1
+        writeCachedDataPoints(cache)
       except Exception:
-        log.msg("Error writing to %s" % (dbFilePath))
         log.err()
-        instrumentation.increment('errors')
-      else:
-        pointCount = len(datapoints)
-        instrumentation.increment('committedPoints', pointCount)
-        instrumentation.append('updateTimes', updateTime)
-        if settings.LOG_UPDATES:
-          log.updates("wrote %d datapoints for %s in %.5f seconds" % (pointCount, metric, updateTime))
-
-    # Avoid churning CPU when only new metrics are in the cache
-    if not dataWritten:
-      time.sleep(0.1)
+      time.sleep(1)  # The writer thread only sleeps when the cache is empty or an error occurs
+  finally:
+    with writersLock:
+      writersRunning -= 1
 
 
-def writeForever():
-  while reactor.running:
+def createForever():
+  # Keep creating until the writers are done and the backlog is empty, so that
+  # no metric handed over at shutdown is lost
+  while reactor.running or writersRunning or CreateBacklog:
     try:
-      writeCachedDataPoints()
+      createBackloggedMetrics()
     except Exception:
       log.err()
-    time.sleep(1)  # The writer thread only sleeps when the cache is empty or an error occurs
+    time.sleep(0.1)  # The create thread only sleeps when the backlog is empty or an error occurs
 
 
 def reloadStorageSchemas():
   global SCHEMAS
   try:
-    SCHEMAS = loadStorageSchemas()
+    schemas = SchemaMatcher(loadStorageSchemas(), settings.SCHEMA_CACHE_SIZE)
+    # Keep the memoized matches unless the definitions actually changed
+    if schemas != SCHEMAS:
+      SCHEMAS = schemas
   except Exception:
     log.msg("Failed to reload storage SCHEMAS")
     log.err()
@@ -173,7 +288,9 @@ def reloadStorageSchemas():
 def reloadAggregationSchemas():
   global AGGREGATION_SCHEMAS
   try:
-    AGGREGATION_SCHEMAS = loadAggregationSchemas()
+    schemas = SchemaMatcher(loadAggregationSchemas(), settings.SCHEMA_CACHE_SIZE)
+    if schemas != AGGREGATION_SCHEMAS:
+      AGGREGATION_SCHEMAS = schemas
   except Exception:
     log.msg("Failed to reload aggregation SCHEMAS")
     log.err()
@@ -182,6 +299,8 @@ def reloadAggregationSchemas():
 def shutdownModifyUpdateSpeed():
     try:
         shut = settings.MAX_UPDATES_PER_SECOND_ON_SHUTDOWN
+        if UPDATE_RATE_CONTROLLER:
+          UPDATE_RATE_CONTROLLER.stop()
         if UPDATE_BUCKET:
           UPDATE_BUCKET.setCapacityAndFillRate(shut,shut)
         if CREATE_BUCKET:
@@ -203,11 +322,24 @@ class WriterService(Service):
           signal.signal(signal.SIGHUP, signal.SIG_IGN)
         self.storage_reload_task.start(60, False)
         self.aggregation_reload_task.start(60, False)
+        if UPDATE_RATE_CONTROLLER:
+          UPDATE_RATE_CONTROLLER.start()
         reactor.addSystemEventTrigger('before', 'shutdown', shutdownModifyUpdateSpeed)
-        reactor.callInThread(writeForever)
+        state.storage_backend.start()
+        # Each writer thread owns a disjoint set of cache shards, while the
+        # create threads share the backlog. Leave the reactor's default ten
+        # pool threads free for everything else.
+        reactor.suggestThreadPoolSize(10 + settings.WRITER_THREADS + settings.CREATE_THREADS)
+        for cache in MetricCache.partition(settings.WRITER_THREADS):
+          reactor.callInThread(writeForever, cache)
+        for _i in range(settings.CREATE_THREADS):
+          reactor.callInThread(createForever)
         Service.startService(self)
 
     def stopService(self):
         self.storage_reload_task.stop()
         self.aggregation_reload_task.stop()
+        if UPDATE_RATE_CONTROLLER:
+          UPDATE_RATE_CONTROLLER.stop()
+        reactor.addSystemEventTrigger('after', 'shutdown', state.storage_backend.stop)
         Service.stopService(self)